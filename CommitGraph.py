@@ -0,0 +1,191 @@
+import mmap
+import struct
+import hashlib
+
+
+# See git's Documentation/gitformat-commit-graph.txt
+GRAPH_MAGIC = b"CGPH"
+CHUNK_OID_FANOUT = b"OIDF"
+CHUNK_OID_LOOKUP = b"OIDL"
+CHUNK_COMMIT_DATA = b"CDAT"
+CHUNK_EXTRA_EDGES = b"EDGE"
+
+PARENT_NONE = 0x70000000
+PARENT_EXTRA = 0x80000000
+GENERATION_MAX = 0x3FFFFFFF
+
+
+class CommitGraph:
+    """A memory-mapped commit-graph file.  Commits are addressed by their
+    position in the sorted OID table; parents are stored as positions
+    too, so a history walk never needs to inflate a commit."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        m = self.map
+        if m[0:4] != GRAPH_MAGIC:
+            raise Exception(f"Not a commit-graph file {path}")
+        version, hash_version, chunk_count = m[4], m[5], m[6]
+        if version != 1 or hash_version != 1:
+            raise Exception(f"Unsupported commit-graph version in {path}")
+
+        self.chunks = dict()
+        for i in range(chunk_count):
+            pos = 8 + 12 * i
+            chunk_id = m[pos : pos + 4]
+            (offset,) = struct.unpack(">Q", m[pos + 4 : pos + 12])
+            self.chunks[chunk_id] = offset
+
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if chunk_id not in self.chunks:
+                raise Exception(f"Missing {chunk_id.decode()} chunk in {path}")
+
+        fanout = self.chunks[CHUNK_OID_FANOUT]
+        self.fanout = struct.unpack(">256I", m[fanout : fanout + 256 * 4])
+        self.count = self.fanout[255]
+        self.oids = self.chunks[CHUNK_OID_LOOKUP]
+        self.data = self.chunks[CHUNK_COMMIT_DATA]
+        self.edges = self.chunks.get(CHUNK_EXTRA_EDGES)
+
+    def __len__(self):
+        return self.count
+
+    def oid(self, pos):
+        """The binary SHA of the commit at pos."""
+        start = self.oids + 20 * pos
+        return self.map[start : start + 20]
+
+    def position(self, binsha):
+        """Return the position of binsha, or None if it isn't in the graph."""
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            oid = self.oid(mid)
+            if oid < binsha:
+                lo = mid + 1
+            elif oid > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def commit(self, pos):
+        """Return (parents, generation, date) for the commit at pos, where
+        parents is a list of positions."""
+        start = self.data + 36 * pos + 20
+        p1, p2, high, low = struct.unpack(">IIII", self.map[start : start + 16])
+
+        parents = list()
+        if p1 != PARENT_NONE:
+            parents.append(p1)
+        if p2 & PARENT_EXTRA:
+            # Octopus merge: p2 points into the extra edges list, whose
+            # last entry has its high bit set.
+            edge = self.edges + 4 * (p2 & ~PARENT_EXTRA)
+            while True:
+                (p,) = struct.unpack(">I", self.map[edge : edge + 4])
+                parents.append(p & ~PARENT_EXTRA)
+                if p & PARENT_EXTRA:
+                    break
+                edge += 4
+        elif p2 != PARENT_NONE:
+            parents.append(p2)
+
+        generation = high >> 2
+        date = ((high & 3) << 32) | low
+        return parents, generation, date
+
+    def tree(self, pos):
+        """The binary SHA of the root tree of the commit at pos."""
+        start = self.data + 36 * pos
+        return self.map[start : start + 20]
+
+    def close(self):
+        self.map.close()
+
+
+def commit_graph_write(f, commits):
+    """Write a commit-graph for commits, a dict mapping each binary SHA
+    to a (tree, parents, date) tuple of binary SHAs and an int.  Every
+    parent must itself be in commits."""
+    oids = sorted(commits)
+    positions = {oid: i for i, oid in enumerate(oids)}
+
+    # Generation numbers: one more than the highest parent, computed
+    # iteratively in post-order so deep histories don't hit the
+    # recursion limit.
+    generations = dict()
+    for oid in oids:
+        stack = [oid]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[top][1] if p not in generations]
+            if pending:
+                stack.extend(pending)
+            else:
+                stack.pop()
+                parents = commits[top][1]
+                gen = 1 + max((generations[p] for p in parents), default=0)
+                generations[top] = min(gen, GENERATION_MAX)
+
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[oid[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    data = bytearray()
+    edges = list()
+    for oid in oids:
+        tree, parents, date = commits[oid]
+        parents = [positions[p] for p in parents]
+
+        p1 = parents[0] if parents else PARENT_NONE
+        if len(parents) > 2:
+            p2 = PARENT_EXTRA | len(edges)
+            edges.extend(parents[1:])
+            edges[-1] |= PARENT_EXTRA
+        elif len(parents) == 2:
+            p2 = parents[1]
+        else:
+            p2 = PARENT_NONE
+
+        high = (generations[oid] << 2) | ((date >> 32) & 3)
+        data += tree + struct.pack(">IIII", p1, p2, high, date & 0xFFFFFFFF)
+
+    chunks = [
+        (CHUNK_OID_FANOUT, struct.pack(">256I", *fanout)),
+        (CHUNK_OID_LOOKUP, b"".join(oids)),
+        (CHUNK_COMMIT_DATA, bytes(data)),
+    ]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGES, struct.pack(f">{len(edges)}I", *edges)))
+
+    sha = hashlib.sha1()
+
+    def write(data):
+        f.write(data)
+        sha.update(data)
+
+    write(GRAPH_MAGIC + bytes([1, 1, len(chunks), 0]))
+
+    # Chunk table of contents, with a terminating entry that marks the
+    # end of the last chunk.
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, chunk in chunks:
+        write(chunk_id + struct.pack(">Q", offset))
+        offset += len(chunk)
+    write(b"\0\0\0\0" + struct.pack(">Q", offset))
+
+    for _, chunk in chunks:
+        write(chunk)
+
+    f.write(sha.digest())
@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+from GitObject import kvlm_parse, tree_parse
+from GitRepository import worker_repo
+
+# The integrity checks of fsck, run in worker processes: each call checks
+# a batch of objects and returns, for those that are sound, their type
+# and what they link to, and for the others what is wrong with them.
+
+
+def object_links(fmt, data):
+    """Parse an object; return the (type, SHA) of every object it names."""
+    if fmt == b"blob":
+        return []
+    if fmt == b"tree":
+        links = list()
+        for item in tree_parse(data):
+            if item.mode == b"160000":
+                # Submodule: the commit lives in another repository.
+                continue
+            links.append((b"tree" if item.mode.startswith(b"4") else b"blob", item.sha))
+        return links
+
+    kvlm = kvlm_parse(data)
+    if fmt == b"commit":
+        links = [(b"tree", kvlm[b"tree"][0].decode("ascii"))]
+        links += [(b"commit", p.decode("ascii")) for p in kvlm.get(b"parent", [])]
+        return links
+    if fmt == b"tag":
+        return [(kvlm[b"type"][0], kvlm[b"object"][0].decode("ascii"))]
+    raise Exception(f"unknown type {fmt.decode('ascii', 'replace')}")
+
+
+def object_check(sha, fmt, data):
+    actual = hashlib.sha1(b"%s %d\x00" % (fmt, len(data)))
+    actual.update(data)
+    if actual.hexdigest() != sha:
+        raise Exception(f"hash mismatch, content hashes to {actual.hexdigest()}")
+    return object_links(fmt, data)
+
+
+def check_loose(path, shas):
+    """Check the loose objects shas of the repository at path.  Return
+    a list of (sha, fmt, links) and a list of (sha, error)."""
+    repo = worker_repo(path)
+    good, bad = list(), list()
+    for sha in shas:
+        try:
+            fmt, data = repo.object_read_loose(sha, repo.object_path(sha))
+            good.append((sha, fmt, object_check(sha, fmt, data)))
+        except Exception as e:
+            bad.append((sha, f"loose object: {e}"))
+    return good, bad
+
+
+def check_packed(path, idx_path, entries):
+    """Check the objects at the given (binsha, offset) entries of the
+    pack of idx_path, as check_loose() does."""
+    repo = worker_repo(path)
+    pack = next(p for p in repo.packs() if p.index.path == idx_path)
+    good, bad = list(), list()
+    for binsha, offset in entries:
+        sha = binsha.hex()
+        try:
+            fmt, data = pack.read_at(offset)
+            good.append((sha, fmt, object_check(sha, fmt, data)))
+        except Exception as e:
+            bad.append((sha, f"in {pack.path}: {e}"))
+    return good, bad
+
+
+def check_pack_checksum(pack_path):
+    """Return an error if the trailing checksum of the pack is wrong."""
+    sha = hashlib.sha1()
+    with open(pack_path, "rb") as f:
+        remaining = os.fstat(f.fileno()).st_size - 20
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+        trailer = f.read(20)
+    if sha.digest() != trailer:
+        return f"{pack_path}: bad pack checksum"
+    return None
@@ -0,0 +1,84 @@
+import fnmatch
+import re
+
+from GitRepository import worker_repo
+
+# The search side of grep, run in worker processes, each of which reads
+# the blobs it is given itself, so that only file names and matching
+# lines cross between processes.
+
+# Like git, a blob with a NUL in its first 8000 bytes is binary.
+BINARY_CHECK = 8000
+
+_patterns = dict()
+
+
+def pathspec_wildcard(spec):
+    return any(c in spec for c in b"*?[")
+
+
+def pathspec_match(path, specs):
+    """Whether path is named by one of specs: the path itself, one of the
+    directories above it, or a glob pattern."""
+    for spec in specs:
+        if path == spec or path.startswith(spec.rstrip(b"/") + b"/"):
+            return True
+        if pathspec_wildcard(spec) and fnmatch.fnmatchcase(path, spec):
+            return True
+    return False
+
+
+def pathspec_dir(path, specs):
+    """Whether anything under directory path may be named by specs."""
+    path += b"/"
+    for spec in specs:
+        # Only the part of a glob before its first wildcard is literal.
+        literal = re.split(rb"[*?[]", spec, 1)[0]
+        if path.startswith(literal) or literal.startswith(path):
+            return True
+    return False
+
+
+def grep_blobs(path, pattern, ignore_case, files_only, entries):
+    """Search the blobs at the given (path, sha) entries of the repository
+    at path.  Return the output for them: a path:line:text line for each
+    line that matches, or with files_only, just the path of the files
+    that do."""
+    repo = worker_repo(path)
+    regex = _patterns.get((pattern, ignore_case))
+    if regex is None:
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        regex = _patterns[(pattern, ignore_case)] = re.compile(pattern, flags)
+
+    out = list()
+    for name, sha in entries:
+        _, _, chunks = repo.object_open(sha)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= BINARY_CHECK:
+                break
+        if b"\x00" in head[:BINARY_CHECK]:
+            # Binary: skip it without inflating the rest.
+            continue
+        data = head + b"".join(chunks)
+
+        match = regex.search(data)
+        if match and match.start() == len(data) and data[-1:] in (b"", b"\n"):
+            # An empty match after the last newline is past the last line.
+            match = None
+        if match and files_only:
+            out.append(name + b"\n")
+            continue
+        lineno, counted = 1, 0
+        while match:
+            start = data.rfind(b"\n", 0, match.start()) + 1
+            end = data.find(b"\n", match.end())
+            if end < 0:
+                end = len(data)
+            lineno += data.count(b"\n", counted, start)
+            counted = start
+            out.append(b"%s:%d:%s\n" % (name, lineno, data[start:end]))
+            # One line per match, however many times it matches.
+            match = regex.search(data, end + 1) if end + 1 < len(data) else None
+    return b"".join(out)
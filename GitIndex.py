@@ -0,0 +1,308 @@
+import array
+import bisect
+import hashlib
+import os
+import stat
+import struct
+
+# See git's Documentation/gitformat-index.txt
+INDEX_MAGIC = b"DIRC"
+
+# Flags of an entry.  The extended flags of version 3 and later live in
+# the upper half.
+FLAG_ASSUME_VALID = 0x8000
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE_MASK = 0x3000
+FLAG_STAGE_SHIFT = 12
+FLAG_NAME_MASK = 0x0FFF
+
+# The stat fields of an entry, in their order on disk.
+STAT_FIELDS = 10
+CTIME_S, CTIME_NS, MTIME_S, MTIME_NS, DEV, INO, MODE, UID, GID, SIZE = range(10)
+
+ENTRY = struct.Struct(">10I20sH")
+
+
+def varint_decode(data, pos):
+    """Decode git's offset varint at pos; return (value, new pos)."""
+    c = data[pos]
+    pos += 1
+    value = c & 0x7F
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7F)
+    return value, pos
+
+
+def varint_encode(value):
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        value -= 1
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def stat_values(st):
+    """The stat fields of an entry for a file with os.lstat result st,
+    truncated to 32 bits as git does."""
+    return (
+        st.st_ctime_ns // 1000000000 & 0xFFFFFFFF,
+        st.st_ctime_ns % 1000000000,
+        st.st_mtime_ns // 1000000000 & 0xFFFFFFFF,
+        st.st_mtime_ns % 1000000000,
+        st.st_dev & 0xFFFFFFFF,
+        st.st_ino & 0xFFFFFFFF,
+        0,  # Mode is set by the caller: it depends on core.filemode.
+        st.st_uid & 0xFFFFFFFF,
+        st.st_gid & 0xFFFFFFFF,
+        st.st_size & 0xFFFFFFFF,
+    )
+
+
+def file_mode(st):
+    """The git mode of a file with os.lstat result st."""
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    if st.st_mode & 0o100:
+        return 0o100755
+    return 0o100644
+
+
+class GitIndex:
+    """The index, aka the staging area, kept as a few flat arrays rather
+    than as an object per entry: the stat data of entry i is
+    stats[10 * i : 10 * i + 10], its binary SHA shas[20 * i : 20 * i + 20],
+    and its path paths[i].  Entries are sorted by path, then stage."""
+
+    def __init__(self, version=2):
+        self.version = version
+        self.paths = list()
+        self.stages = array.array("B")
+        self.stats = array.array("I")
+        self.shas = bytearray()
+        self.flags = array.array("I")
+        # The mtime of the index file it was read from, to spot racily
+        # clean entries: a file modified in the same second the index was
+        # written may have changed without its stat data showing it.
+        self.mtime = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def read(path):
+        """Read the index file at path, or return an empty index if there
+        is none."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+        except FileNotFoundError:
+            return GitIndex()
+
+        index = GitIndex.parse(data, path)
+        index.mtime = mtime
+        return index
+
+    @staticmethod
+    def parse(data, path="index"):
+        if len(data) < 32 or data[0:4] != INDEX_MAGIC:
+            raise Exception(f"Not an index file {path}")
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise Exception(f"Bad checksum in index file {path}")
+        version, count = struct.unpack(">II", data[4:12])
+        if version not in (2, 3, 4):
+            raise Exception(f"Unsupported index version {version} in {path}")
+
+        index = GitIndex(version)
+        stats = index.stats
+        pos = 12
+        previous = b""
+        for _ in range(count):
+            fields = ENTRY.unpack_from(data, pos)
+            start = pos
+            pos += ENTRY.size
+            flags = fields[11]
+            if flags & FLAG_EXTENDED:
+                (extended,) = struct.unpack_from(">H", data, pos)
+                flags |= extended << 16
+                pos += 2
+
+            if version == 4:
+                strip, pos = varint_decode(data, pos)
+                end = data.index(b"\x00", pos)
+                name = previous[: len(previous) - strip] + data[pos:end]
+                pos = end + 1
+            else:
+                length = flags & FLAG_NAME_MASK
+                if length == FLAG_NAME_MASK:
+                    end = data.index(b"\x00", pos)
+                else:
+                    end = pos + length
+                name = data[pos:end]
+                # Entries are padded with 1 to 8 NULs to a multiple of 8.
+                pos = start + ((end - start + 8) & ~7)
+            previous = name
+
+            stats.extend(fields[:STAT_FIELDS])
+            index.shas += fields[10]
+            index.flags.append(flags)
+            index.stages.append((flags & FLAG_STAGE_MASK) >> FLAG_STAGE_SHIFT)
+            index.paths.append(name)
+
+        # Extensions follow the entries.  Optional ones, whose signature
+        # starts with an uppercase letter, are caches we can do without:
+        # they are dropped, and not written back.
+        end = len(data) - 20
+        while pos < end:
+            signature = data[pos : pos + 4]
+            (size,) = struct.unpack(">I", data[pos + 4 : pos + 8])
+            if not b"A" <= signature[0:1] <= b"Z":
+                raise Exception(f"Unsupported index extension {signature!r} in {path}")
+            pos += 8 + size
+
+        return index
+
+    def serialize(self):
+        version = self.version
+        if version == 2 and any(flags >> 16 for flags in self.flags):
+            version = 3
+
+        out = [INDEX_MAGIC, struct.pack(">II", version, len(self.paths))]
+        previous = b""
+        for i, name in enumerate(self.paths):
+            flags = self.flags[i] & (FLAG_ASSUME_VALID | FLAG_STAGE_MASK)
+            flags |= min(len(name), FLAG_NAME_MASK)
+            extended = self.flags[i] >> 16
+            if extended:
+                flags |= FLAG_EXTENDED
+            entry = ENTRY.pack(
+                *self.stats[STAT_FIELDS * i : STAT_FIELDS * i + STAT_FIELDS],
+                bytes(self.shas[20 * i : 20 * i + 20]),
+                flags,
+            )
+            if extended:
+                entry += struct.pack(">H", extended)
+
+            if version == 4:
+                common = os.path.commonprefix([previous, name])
+                entry += varint_encode(len(previous) - len(common))
+                entry += name[len(common) :] + b"\x00"
+            else:
+                entry += name
+                entry += b"\x00" * (8 - len(entry) % 8)
+            previous = name
+            out.append(entry)
+
+        data = b"".join(out)
+        return data + hashlib.sha1(data).digest()
+
+    def write(self, path):
+        """Write the index to path, through a lock file as git does, so
+        that concurrent writers fail rather than corrupt it."""
+        lock = path + ".lock"
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            raise Exception(f"Unable to lock {path}: {lock} exists")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.serialize())
+            os.rename(lock, path)
+        except BaseException:
+            os.remove(lock)
+            raise
+        self.mtime = os.stat(path).st_mtime_ns
+
+    def find(self, path, stage=0):
+        """The position of the entry for path at stage, or None."""
+        i = bisect.bisect_left(self.paths, path)
+        while i < len(self.paths) and self.paths[i] == path:
+            if self.stages[i] == stage:
+                return i
+            i += 1
+        return None
+
+    def prefix(self, path):
+        """The range of positions of the entries for path if it is a file,
+        or else of those under it."""
+        lo = bisect.bisect_left(self.paths, path)
+        hi = bisect.bisect_right(self.paths, path)
+        if lo < hi:
+            return lo, hi
+        # Paths under path/ sort before path0, as "0" follows "/".
+        lo = bisect.bisect_left(self.paths, path + b"/")
+        hi = bisect.bisect_left(self.paths, path + b"0")
+        return lo, hi
+
+    def sha(self, i):
+        return self.shas[20 * i : 20 * i + 20].hex()
+
+    def mode(self, i):
+        return self.stats[STAT_FIELDS * i + MODE]
+
+    def stat(self, i):
+        return self.stats[STAT_FIELDS * i : STAT_FIELDS * i + STAT_FIELDS]
+
+    def set(self, path, sha, mode, st):
+        """Add or replace the stage 0 entry for path.  Any entries of
+        other stages, left by a conflict, are dropped."""
+        values = list(stat_values(st))
+        values[MODE] = mode
+        lo = bisect.bisect_left(self.paths, path)
+        hi = bisect.bisect_right(self.paths, path)
+        if hi - lo == 1 and self.stages[lo] == 0:
+            self.stats[STAT_FIELDS * lo : STAT_FIELDS * lo + STAT_FIELDS] = array.array(
+                "I", values
+            )
+            self.shas[20 * lo : 20 * lo + 20] = bytes.fromhex(sha)
+            self.flags[lo] = 0
+            return
+        self.remove(lo, hi)
+        self.paths.insert(lo, path)
+        self.stages.insert(lo, 0)
+        self.stats[STAT_FIELDS * lo : STAT_FIELDS * lo] = array.array("I", values)
+        self.shas[20 * lo : 20 * lo] = bytes.fromhex(sha)
+        self.flags.insert(lo, 0)
+
+    def refresh(self, i, st):
+        """Record new stat data for entry i, whose contents are unchanged."""
+        values = list(stat_values(st))
+        values[MODE] = self.mode(i)
+        self.stats[STAT_FIELDS * i : STAT_FIELDS * i + STAT_FIELDS] = array.array(
+            "I", values
+        )
+
+    def remove(self, lo, hi):
+        """Remove the entries at positions lo to hi."""
+        del self.paths[lo:hi]
+        del self.stages[lo:hi]
+        del self.stats[STAT_FIELDS * lo : STAT_FIELDS * hi]
+        del self.shas[20 * lo : 20 * hi]
+        del self.flags[lo:hi]
+
+    def stat_matches(self, i, st):
+        """Whether the stat data of entry i still describes a file with
+        os.lstat result st.  If it does, and the entry isn't racily clean,
+        the file can be trusted not to have changed."""
+        if file_mode(st) & 0o170000 != self.mode(i) & 0o170000:
+            return False
+        values = stat_values(st)
+        base = STAT_FIELDS * i
+        stats = self.stats
+        return all(
+            stats[base + field] == values[field]
+            for field in (MTIME_S, MTIME_NS, CTIME_S, CTIME_NS, INO, UID, GID, SIZE)
+        )
+
+    def is_racy(self, i):
+        """Whether entry i was written too close to the index to be
+        trusted from its stat data alone."""
+        if self.mtime is None:
+            return True
+        base = STAT_FIELDS * i
+        mtime = self.stats[base + MTIME_S] * 1000000000 + self.stats[base + MTIME_NS]
+        return mtime >= self.mtime
@@ -1,6 +1,37 @@
+import os
 import hashlib
 import zlib
+import array
 import collections
+import collections.abc
+import types
+import concurrent.futures
+import tempfile
+
+import PerfTrace
+
+
+# How much of a large object we hold in memory at once when streaming it.
+CHUNK_SIZE = 1024 * 1024
+
+
+def inflate_stream(read, chunk_size=CHUNK_SIZE):
+    """Yield the decompressed contents of the zlib stream produced by
+    read(n), in chunks of at most chunk_size bytes."""
+    d = zlib.decompressobj()
+    consumed = inflated = 0
+    while not d.eof:
+        data = d.unconsumed_tail or read(chunk_size)
+        if not data:
+            raise Exception("Truncated zlib stream")
+        out = d.decompress(data, chunk_size)
+        if PerfTrace.enabled:
+            consumed += len(data) - len(d.unconsumed_tail) - len(d.unused_data)
+            inflated += len(out)
+        if out:
+            yield out
+    if PerfTrace.enabled:
+        PerfTrace.count("inflate_stream", consumed, inflated)
 
 
 def kvlm_parse(raw, start=0, kvs=None):
@@ -50,14 +81,17 @@ def kvlm_parse(raw, start=0, kvs=None):
 
 
 def kvlm_serialize(kvlm):
-    return b"\n".join(
-        [
-            key + b" " + val.replace(b"\n", b"\n ")
+    # Headers, with continuation lines indented, then a blank line and
+    # the message.
+    return (
+        b"".join(
+            key + b" " + val.replace(b"\n", b"\n ") + b"\n"
             for key, vals in kvlm.items()
             if key != b""
             for val in vals
-        ]
-        + kvlm[b""]
+        )
+        + b"\n"
+        + b"".join(kvlm[b""])
     )
 
 
@@ -65,6 +99,11 @@ class GitObject:
 
     repo = None
 
+    # Objects returned by object_read are shared through the object
+    # cache, so they are frozen: their contents can't be replaced, and
+    # what they parse to is read-only.
+    frozen = False
+
     def __init__(self, repo, data=None):
         self.repo = repo
 
@@ -83,6 +122,16 @@ class GitObject:
     def deserialize(self, data):
         raise Exception("Unimplemented!")
 
+    def parse(self):
+        """Parse the whole object now rather than on first use, raising
+        if it is malformed."""
+
+    def check_writable(self):
+        if self.frozen:
+            raise Exception(
+                f"Object {self.fmt.decode()} read from the repository is read-only"
+            )
+
     def object_write(self, actually_write=True):
         # Serialize object data
         data = self.serialize()
@@ -91,20 +140,19 @@ class GitObject:
         # Compute hash
         sha = hashlib.sha1(result).hexdigest()
 
-        if actually_write:
-            # Compute path
-            path = self.repo.repo_file(
-                "objects", sha[0:2], sha[2:], mkdir=actually_write
-            )
-
-            with open(path, "wb") as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+        if actually_write and not self.repo.object_exists(sha):
+            # Compress and write
+            object_store(self.repo, sha, [zlib.compress(result, self.repo.compression)])
 
         return sha
 
     @staticmethod
     def hash(fd, fmt, repo=None):
+        if fmt == b"blob":
+            # Blobs need no parsing, so we never hold them in memory.
+            size = os.fstat(fd.fileno()).st_size
+            return GitObject.hash_stream(fd, fmt, size, repo)
+
         data = fd.read()
 
         # Choose constructor depending on
@@ -120,13 +168,133 @@ class GitObject:
         else:
             raise Exception(f"Unknown type {fmt}!")
 
+        # Reading parses lazily, but what gets written must be valid.
+        try:
+            obj.parse()
+        except Exception as e:
+            reason = str(e) or type(e).__name__
+            raise Exception(f"Malformed {fmt.decode()} object: {reason}")
+
         return obj.object_write(repo)
 
+    @staticmethod
+    def hash_stream(fd, fmt, size, repo=None, chunk_size=CHUNK_SIZE):
+        """Hash, and if repo is given store, the size bytes read from fd
+        as an object of type fmt.  Objects the repository already has are
+        not written again.  Data goes through the SHA-1 and the
+        compressor chunk_size bytes at a time, into a temporary file that
+        is renamed into place once its name is known."""
+        header = fmt + b" " + str(size).encode() + b"\x00"
+        sha = hashlib.sha1(header)
+
+        if size <= chunk_size:
+            # Small enough to hold: hash first, and only compress if the
+            # object turns out to be new.
+            data = fd.read(size)
+            if len(data) != size or fd.read(1):
+                raise Exception("File changed size while being hashed")
+            sha.update(data)
+            sha = sha.hexdigest()
+            if repo and not repo.object_exists(sha):
+                object_store(
+                    repo, sha, [zlib.compress(header + data, repo.compression)]
+                )
+            return sha
+
+        out = None
+        if repo:
+            tmp_fd, tmp_path = tempfile.mkstemp(
+                prefix="tmp_obj_", dir=repo.repo_dir("objects")
+            )
+            out = os.fdopen(tmp_fd, "wb")
+            compressor = zlib.compressobj(repo.compression)
+            out.write(compressor.compress(header))
+
+        try:
+            remaining = size
+            while remaining:
+                chunk = fd.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                sha.update(chunk)
+                if out:
+                    out.write(compressor.compress(chunk))
+
+            if remaining or fd.read(1):
+                raise Exception("File changed size while being hashed")
+
+            if out:
+                out.write(compressor.flush())
+                repo.object_fsync(out)
+                out.close()
+        except BaseException:
+            if out:
+                out.close()
+                os.remove(tmp_path)
+            raise
+
+        sha = sha.hexdigest()
+        if out:
+            if repo.object_exists(sha):
+                os.remove(tmp_path)
+            else:
+                repo.object_install(sha, tmp_path)
+
+        return sha
+
+
+def object_store(repo, sha, chunks):
+    """Write the compressed chunks as loose object sha, through a
+    temporary file so that the object never exists half-written."""
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=repo.repo_dir("objects"))
+    try:
+        with os.fdopen(tmp_fd, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+            repo.object_fsync(out)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    repo.object_install(sha, tmp_path)
+
+
+def hash_file(path, fmt, repo=None):
+    with open(path, "rb") as fd:
+        return GitObject.hash(fd, fmt, repo)
+
+
+def hash_files(paths, fmt, repo=None, jobs=None):
+    """Yield the SHA of each file in paths, in order, hashing (and, if
+    repo is given, storing) them from a pool of threads.  SHA-1 and zlib
+    both release the GIL while they work on large buffers."""
+    jobs = jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = collections.deque()
+        for path in paths:
+            futures.append(pool.submit(hash_file, path, fmt, repo))
+            # Keep the queue bounded, so that paths can be a stream.
+            while len(futures) > 4 * jobs:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
 
 class GitBlob(GitObject):
 
     fmt = b"blob"
 
+    _blobdata = None
+
+    @property
+    def blobdata(self):
+        return self._blobdata
+
+    @blobdata.setter
+    def blobdata(self, data):
+        self.check_writable()
+        self._blobdata = data
+
     def serialize(self):
         return self.blobdata
 
@@ -137,24 +305,76 @@ class GitBlob(GitObject):
 class GitCommit(GitObject):
     fmt = b"commit"
 
+    # The raw data is only parsed into self.kvlm when that is first
+    # accessed; plenty of commits are read only to be written back out,
+    # or not looked at at all.
+    _raw = None
+    _kvlm = None
+
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self._raw = data
+        self._kvlm = None
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None and self._raw is not None:
+            kvlm = kvlm_parse(self._raw)
+            if self.frozen:
+                kvlm = types.MappingProxyType(
+                    collections.OrderedDict((k, tuple(v)) for k, v in kvlm.items())
+                )
+            self._kvlm = kvlm
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, kvlm):
+        self.check_writable()
+        self._kvlm = kvlm
+        self._raw = None
+
+    def parse(self):
+        self.kvlm
 
     def serialize(self):
-        return kvlm_serialize(self.kvlm)
+        if self._raw is not None:
+            return self._raw
+        return kvlm_serialize(self._kvlm)
 
 
 class GitTreeLeaf:
-    def __init__(self, mode, path, sha):
+    """A tree entry.  Entries parsed from a tree keep their SHA as a
+    binary view into the tree's buffer, and only build the hex string
+    when asked for it."""
+
+    __slots__ = ("mode", "path", "_sha", "_binsha")
+
+    def __init__(self, mode, path, sha=None, binsha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self._sha = sha
+        self._binsha = binsha
+
+    @property
+    def sha(self):
+        if self._sha is None:
+            self._sha = self._binsha.hex()
+        return self._sha
+
+    @property
+    def binsha(self):
+        if self._binsha is None:
+            self._binsha = bytes.fromhex(self._sha)
+        return self._binsha
+
+    def sort_key(self):
+        # Git sorts trees as if their name ended with a slash.
+        return self.path + b"/" if self.mode.startswith(b"4") else self.path
 
 
-def tree_parse_one(raw, start=0):
+def tree_parse_one(raw, start=0, view=None):
     # Find the space terminator of the mode
     x = raw.find(b" ", start)
-    assert x - start is 5 or x - start is 6
+    assert x - start == 5 or x - start == 6
 
     # Read the mode
     mode = raw[start:x]
@@ -164,10 +384,9 @@ def tree_parse_one(raw, start=0):
     # and read the path
     path = raw[x + 1 : y]
 
-    # Read the SHA and convert to an hex string
-    # hex() adds 0x in front, we don't want that.
-    sha = hex(int.from_bytes(raw[y + 1 : y + 21], "big"))[2:]
-    return y + 21, GitTreeLeaf(mode, path, sha)
+    # Keep the SHA binary: a view if we have one, else a copy.
+    binsha = (view if view is not None else raw)[y + 1 : y + 21]
+    return y + 21, GitTreeLeaf(mode, path, binsha=binsha)
 
 
 def tree_parse(raw):
@@ -181,25 +400,98 @@ def tree_parse(raw):
 
 
 def tree_serialize(obj):
-    return "".join(
-        [
-            item.mode
-            + b" "
-            + item.path
-            + b"\x00"
-            + int(item.sha, 16).to_bytes(20, byteorder="big")
-            for item in obj.items
-        ]
+    return b"".join(
+        [item.mode + b" " + item.path + b"\x00" + item.binsha for item in obj.items]
     )
 
 
+class GitTreeEntries(collections.abc.Sequence):
+    """A read-only sequence of the entries of a parsed tree, built on
+    demand from its raw data."""
+
+    __slots__ = ("tree",)
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree.offsets())
+
+    def __getitem__(self, i):
+        offsets = self.tree.offsets()
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(offsets)))]
+        return tree_parse_one(self.tree.raw, offsets[i], self.tree.view)[1]
+
+    def __iter__(self):
+        # Plain iteration needs no offsets table.
+        raw = self.tree.raw
+        view = self.tree.view
+        pos = 0
+        end = len(raw)
+        while pos < end:
+            pos, leaf = tree_parse_one(raw, pos, view)
+            yield leaf
+
+
 class GitTree(GitObject):
+    """A tree.  A parsed tree keeps its raw data, plus an array of entry
+    offsets built the first time an entry is looked up by position or
+    name; entries themselves are only created as they are accessed."""
+
     fmt = b"tree"
 
+    raw = None
+    view = None
+    _offsets = None
+    _items = None
+
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self.view = memoryview(data)
+        self._offsets = None
+        self._items = None
+
+    @property
+    def items(self):
+        if self._items is not None:
+            return self._items
+        return GitTreeEntries(self)
+
+    @items.setter
+    def items(self, items):
+        self.check_writable()
+        self._items = items
+        self.raw = self.view = self._offsets = None
+
+    def parse(self):
+        # Entries are read without bounds checks, so check them here.
+        raw = self.raw
+        pos = 0
+        while raw is not None and pos < len(raw):
+            start = pos
+            pos, leaf = tree_parse_one(raw, pos)
+            nul = pos - 21
+            if not leaf.mode.isdigit() or nul <= start or raw[nul] != 0:
+                raise Exception(f"bad tree entry at offset {start}")
+            if pos > len(raw) or not leaf.path or b"/" in leaf.path:
+                raise Exception(f"bad tree entry at offset {start}")
+
+    def offsets(self):
+        if self._offsets is None:
+            raw = self.raw
+            offsets = array.array("I")
+            pos = 0
+            end = len(raw)
+            while pos < end:
+                offsets.append(pos)
+                pos = raw.find(b"\x00", pos) + 21
+            self._offsets = offsets
+        return self._offsets
 
     def serialize(self):
+        if self._items is None:
+            return self.raw
         return tree_serialize(self)
 
 
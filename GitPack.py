@@ -0,0 +1,664 @@
+import os
+import mmap
+import struct
+import zlib
+import hashlib
+import tempfile
+import threading
+import collections
+
+import PerfTrace
+from GitObject import inflate_stream
+
+
+# Object types, as stored in the 3-bit type field of a pack entry header.
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+type_names = {
+    OBJ_COMMIT: b"commit",
+    OBJ_TREE: b"tree",
+    OBJ_BLOB: b"blob",
+    OBJ_TAG: b"tag",
+}
+
+type_numbers = {v: k for k, v in type_names.items()}
+
+IDX_MAGIC = b"\377tOc"
+PACK_MAGIC = b"PACK"
+
+
+def _mmap_file(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def delta_header_size(delta, pos):
+    """Read one of the two variable-length sizes at the start of a delta."""
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, size
+
+
+def delta_apply(base, delta):
+    """Apply a git delta to base, and return the resulting bytes."""
+    pos, src_size = delta_header_size(delta, 0)
+    pos, dst_size = delta_header_size(delta, pos)
+
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+
+        if op & 0x80:
+            # Copy instruction.  The low four bits say which offset
+            # bytes follow, the next three which size bytes follow.
+            offset = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset : offset + size]
+        elif op:
+            # Insert instruction: the next op bytes are literal data.
+            out += delta[pos : pos + op]
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch")
+
+    return bytes(out)
+
+
+class GitPackIndex:
+    """A memory-mapped version 2 pack index (.idx file)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.map = _mmap_file(path)
+
+        if self.map[0:4] != IDX_MAGIC:
+            raise Exception(f"Unsupported pack index {path}")
+        (version,) = struct.unpack(">I", self.map[4:8])
+        if version != 2:
+            raise Exception(f"Unsupported pack index version {version} in {path}")
+
+        self.fanout = struct.unpack(">256I", self.map[8 : 8 + 256 * 4])
+        self.count = self.fanout[255]
+
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, i):
+        """The binary SHA of the i-th entry."""
+        pos = self.sha_table + 20 * i
+        return self.map[pos : pos + 20]
+
+    def offset(self, i):
+        """The pack offset of the i-th entry."""
+        pos = self.offset_table + 4 * i
+        (offset,) = struct.unpack(">I", self.map[pos : pos + 4])
+        if offset & 0x80000000:
+            # MSB set: the offset lives in the 64-bit table.
+            pos = self.large_offset_table + 8 * (offset & 0x7FFFFFFF)
+            (offset,) = struct.unpack(">Q", self.map[pos : pos + 8])
+        return offset
+
+    def offsets(self):
+        """The pack offsets of all entries, in index order."""
+        offsets = struct.unpack_from(f">{self.count}I", self.map, self.offset_table)
+        if not any(offset & 0x80000000 for offset in offsets):
+            return offsets
+        return [self.offset(i) for i in range(self.count)]
+
+    def bisect(self, binsha):
+        """Return the position of the first entry whose SHA is not lower
+        than binsha.  binsha may be shorter than 20 bytes."""
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        n = len(binsha)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.sha_table + 20 * mid
+            if self.map[pos : pos + n] < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, binsha):
+        """Return the pack offset of binsha, or None."""
+        i = self.bisect(binsha)
+        if i < self.count and self.sha(i) == binsha:
+            return self.offset(i)
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.sha(i), self.offset(i)
+
+    def close(self):
+        self.map.close()
+
+
+class GitPack:
+    """A packfile and its index.  Objects are read straight out of the
+    memory-mapped .pack; resolved delta bases are kept in a small LRU
+    cache bounded by total size, since the same base tends to serve
+    many deltas in a row."""
+
+    def __init__(self, repo, idx_path, cache_size=16 * 1024 * 1024):
+        self.repo = repo
+        self.index = GitPackIndex(idx_path)
+        self.path = idx_path[:-4] + ".pack"
+        self.map = _mmap_file(self.path)
+
+        if self.map[0:4] != PACK_MAGIC:
+            raise Exception(f"Not a packfile {self.path}")
+        version, count = struct.unpack(">II", self.map[4:12])
+        if version not in (2, 3):
+            raise Exception(f"Unsupported pack version {version} in {self.path}")
+        if count != len(self.index):
+            raise Exception(f"Pack {self.path} does not match its index")
+
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.cache_size = cache_size
+        # Checkout reads packs from several threads at once.
+        self.cache_lock = threading.Lock()
+
+    def __contains__(self, binsha):
+        return self.index.find(binsha) is not None
+
+    def read(self, binsha):
+        """Return (fmt, data) for binsha, or None if it is not in this pack."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+        return self.read_at(offset)
+
+    def entry_header(self, offset):
+        """Parse the entry header at offset.  Return the type, the
+        inflated size, the offset of the zlib stream and, for deltas,
+        the base (an offset for OFS_DELTA, a binary SHA for REF_DELTA)."""
+        m = self.map
+        c = m[offset]
+        pos = offset + 1
+        typ = (c >> 4) & 7
+        size = c & 0x0F
+        shift = 4
+        while c & 0x80:
+            c = m[pos]
+            pos += 1
+            size |= (c & 0x7F) << shift
+            shift += 7
+
+        base = None
+        if typ == OBJ_OFS_DELTA:
+            c = m[pos]
+            pos += 1
+            rel = c & 0x7F
+            while c & 0x80:
+                c = m[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7F)
+            base = offset - rel
+        elif typ == OBJ_REF_DELTA:
+            base = m[pos : pos + 20]
+            pos += 20
+
+        return typ, size, pos, base
+
+    def inflate(self, pos, size, chunk=65536):
+        """Inflate the zlib stream starting at pos."""
+        d = zlib.decompressobj()
+        view = memoryview(self.map)
+        out = []
+        start = pos
+        try:
+            while not d.eof:
+                block = view[pos : pos + chunk]
+                if not block:
+                    raise Exception(f"Truncated object in {self.path}")
+                out.append(d.decompress(block))
+                pos += len(block)
+        finally:
+            view.release()
+        data = b"".join(out)
+        if PerfTrace.enabled:
+            PerfTrace.count("pack inflate", pos - start - len(d.unused_data), len(data))
+        if len(data) != size:
+            raise Exception(f"Corrupt object in {self.path}: bad length")
+        return data
+
+    def info(self, binsha):
+        """Return (fmt, size) for binsha, or None if it is not in this
+        pack.  Only headers are parsed, and for deltas, the delta itself
+        is inflated for its size: no base ever needs to be."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+
+        typ, size, pos, base = self.entry_header(offset)
+        if typ in type_names:
+            return type_names[typ], size
+
+        # The result size is the second varint of the delta.
+        delta = self.inflate(pos, size)
+        size = delta_header_size(delta, delta_header_size(delta, 0)[0])[1]
+
+        # And the type is the one of the object at the end of the chain.
+        while typ not in type_names:
+            if typ == OBJ_OFS_DELTA:
+                offset = base
+            else:
+                offset = self.index.find(base)
+                if offset is None:
+                    return self.repo.object_info(base.hex())[0], size
+            typ, _, _, base = self.entry_header(offset)
+
+        return type_names[typ], size
+
+    def stream(self, binsha):
+        """Like read, but return (fmt, size, chunks) where chunks is an
+        iterator over the contents.  Only whole objects are streamed from
+        the pack; deltas have to be resolved in memory."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+
+        typ, size, pos, _ = self.entry_header(offset)
+        if typ not in type_names:
+            fmt, data = self.read_at(offset)
+            return fmt, len(data), iter([data])
+
+        def read(n):
+            nonlocal pos
+            block = self.map[pos : pos + n]
+            pos += len(block)
+            return block
+
+        return type_names[typ], size, inflate_stream(read)
+
+    def read_at(self, offset):
+        # Walk down the delta chain until we reach a full object, either
+        # in the pack or in the cache, remembering the deltas on the way.
+        deltas = []
+        while True:
+            cached = self.cache_get(offset)
+            if cached:
+                typ, data = cached
+                break
+
+            typ, size, pos, base = self.entry_header(offset)
+
+            if typ == OBJ_OFS_DELTA:
+                deltas.append((offset, self.inflate(pos, size)))
+                offset = base
+            elif typ == OBJ_REF_DELTA:
+                deltas.append((offset, self.inflate(pos, size)))
+                base_offset = self.index.find(base)
+                if base_offset is None:
+                    # Thin pack: the base lives elsewhere in the repo.
+                    fmt, data = self.repo.object_read_raw(base.hex())
+                    typ = type_numbers[fmt]
+                    break
+                offset = base_offset
+            elif typ in type_names:
+                data = self.inflate(pos, size)
+                if deltas:
+                    self.cache_add(offset, typ, data)
+                break
+            else:
+                raise Exception(f"Unknown pack object type {typ} in {self.path}")
+
+        # Now replay the deltas, innermost first.
+        while deltas:
+            offset, delta = deltas.pop()
+            data = delta_apply(data, delta)
+            if deltas:
+                self.cache_add(offset, typ, data)
+
+        return type_names[typ], data
+
+    def cache_get(self, offset):
+        with self.cache_lock:
+            entry = self.cache.get(offset)
+            if entry:
+                self.cache.move_to_end(offset)
+            return entry
+
+    def cache_add(self, offset, typ, data):
+        with self.cache_lock:
+            if len(data) > self.cache_size or offset in self.cache:
+                return
+            self.cache[offset] = (typ, data)
+            self.cache_bytes += len(data)
+            while self.cache_bytes > self.cache_size:
+                _, (_, old) = self.cache.popitem(last=False)
+                self.cache_bytes -= len(old)
+
+    def close(self):
+        self.map.close()
+        self.index.close()
+
+
+def pack_list(pack_dir, repo):
+    """Open every pack found in pack_dir."""
+    if not pack_dir:
+        return []
+
+    ret = []
+    for f in sorted(os.listdir(pack_dir)):
+        if f.endswith(".idx") and os.path.exists(
+            os.path.join(pack_dir, f[:-4] + ".pack")
+        ):
+            ret.append(GitPack(repo, os.path.join(pack_dir, f)))
+    return ret
+
+
+def delta_header(size):
+    """Encode size as the variable-length integer used in delta headers."""
+    out = bytearray()
+    while True:
+        c = size & 0x7F
+        size >>= 7
+        if size:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return out
+
+
+DELTA_BLOCK = 16
+
+
+def delta_index(base):
+    """Map each aligned block of base to its offset, for delta_create."""
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i : i + DELTA_BLOCK], i)
+    return index
+
+
+def delta_create(base, target, index=None, max_size=None):
+    """Compute a delta turning base into target.  Return None if it
+    would be larger than max_size."""
+    if index is None:
+        index = delta_index(base)
+    if max_size is None:
+        max_size = len(target)
+
+    out = delta_header(len(base)) + delta_header(len(target))
+    base_len = len(base)
+    target_len = len(target)
+
+    def insert(start, end):
+        while start < end:
+            n = min(end - start, 0x7F)
+            out.append(n)
+            out.extend(target[start : start + n])
+            start += n
+
+    def copy(offset, size):
+        while size:
+            n = min(size, 0xFFFFFF)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (offset >> (8 * i)) & 0xFF
+                if byte:
+                    op |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = (n >> (8 * i)) & 0xFF
+                if byte:
+                    op |= 1 << (4 + i)
+                    args.append(byte)
+            out.append(op)
+            out.extend(args)
+            offset += n
+            size -= n
+
+    pending = 0
+    i = 0
+    while i <= target_len - DELTA_BLOCK:
+        offset = index.get(target[i : i + DELTA_BLOCK])
+        if offset is None:
+            i += 1
+            continue
+
+        # Grow the match backwards into the pending literal data...
+        while offset > 0 and i > pending and base[offset - 1] == target[i - 1]:
+            offset -= 1
+            i -= 1
+
+        # ...and forwards, a whole block at a time while we can.
+        n = DELTA_BLOCK
+        while (
+            i + n + DELTA_BLOCK <= target_len
+            and offset + n + DELTA_BLOCK <= base_len
+            and target[i + n : i + n + DELTA_BLOCK]
+            == base[offset + n : offset + n + DELTA_BLOCK]
+        ):
+            n += DELTA_BLOCK
+        while (
+            i + n < target_len
+            and offset + n < base_len
+            and target[i + n] == base[offset + n]
+        ):
+            n += 1
+
+        insert(pending, i)
+        copy(offset, n)
+        i += n
+        pending = i
+
+        if len(out) > max_size:
+            return None
+
+    insert(pending, target_len)
+
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def pack_entry_header(typ, size):
+    c = (typ << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7F
+        size >>= 7
+    out.append(c)
+    return out
+
+
+def pack_ofs_encode(rel):
+    out = bytearray([rel & 0x7F])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        out.insert(0, 0x80 | (rel & 0x7F))
+        rel >>= 7
+    return out
+
+
+class GitPackWriter:
+    """Write a packfile, one object at a time.
+
+    Each object is tried as a delta against the last `window` objects
+    of the same type; since callers feed objects sorted by type and
+    path, those are most often earlier versions of the same file.  Only
+    the window is kept in memory, and everything else goes straight to
+    disk."""
+
+    def __init__(self, pack_dir, count, window=10, depth=50, delta_limit=1 << 20):
+        self.pack_dir = pack_dir
+        self.count = count
+        self.window = collections.deque(maxlen=window)
+        self.depth = depth
+        self.delta_limit = delta_limit
+        self.entries = list()
+        self.written = 0
+
+        fd, self.tmp_path = tempfile.mkstemp(prefix="tmp_pack_", dir=pack_dir)
+        self.f = os.fdopen(fd, "wb")
+        self.sha = hashlib.sha1()
+        self.offset = 0
+        self.write(PACK_MAGIC + struct.pack(">II", 2, count))
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha.update(data)
+        self.offset += len(data)
+
+    def delta_find(self, typ, data):
+        """Return the best (window entry, delta) pair for data, if any."""
+        best = None
+        max_size = len(data) // 2 - 20
+        if len(data) > self.delta_limit or max_size <= 0:
+            return None
+
+        for entry in self.window:
+            base_typ, base_data, _, depth, index = entry[:5]
+            if base_typ != typ or depth >= self.depth:
+                continue
+            if len(base_data) < len(data) // 16:
+                continue
+            if index is None:
+                index = entry[4] = delta_index(base_data)
+            delta = delta_create(base_data, data, index=index, max_size=max_size)
+            if delta is not None:
+                best = (entry, delta)
+                max_size = len(delta) - 1
+
+        return best
+
+    def add(self, sha, fmt, data):
+        """Append object sha, of type fmt, to the pack."""
+        typ = type_numbers[fmt]
+        offset = self.offset
+
+        found = self.delta_find(typ, data)
+        if found:
+            base, delta = found
+            header = pack_entry_header(OBJ_OFS_DELTA, len(delta))
+            header += pack_ofs_encode(offset - base[2])
+            body = zlib.compress(delta)
+            depth = base[3] + 1
+        else:
+            header = pack_entry_header(typ, len(data))
+            body = zlib.compress(data)
+            depth = 0
+
+        self.write(header)
+        self.write(body)
+        crc = zlib.crc32(body, zlib.crc32(header))
+        self.entries.append((bytes.fromhex(sha), crc, offset))
+
+        if len(data) <= self.delta_limit:
+            self.window.append([typ, data, offset, depth, None])
+        self.written += 1
+
+    def finish(self):
+        """Write the trailer and the index.  Return the path of the new
+        .idx file."""
+        if self.written != self.count:
+            raise Exception(
+                f"Pack header announced {self.count} objects, got {self.written}"
+            )
+
+        checksum = self.sha.digest()
+        self.f.write(checksum)
+        self.f.close()
+
+        name = "pack-" + checksum.hex()
+        pack_path = os.path.join(self.pack_dir, name + ".pack")
+        idx_path = os.path.join(self.pack_dir, name + ".idx")
+
+        idx_tmp = self.tmp_path + ".idx"
+        with open(idx_tmp, "wb") as f:
+            pack_index_write(f, self.entries, checksum)
+
+        # Packs are never modified once written.
+        for path in (self.tmp_path, idx_tmp):
+            os.chmod(path, 0o444)
+        os.rename(self.tmp_path, pack_path)
+        os.rename(idx_tmp, idx_path)
+        return idx_path
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+
+def pack_index_write(f, entries, pack_checksum):
+    """Write a version 2 index for entries, a list of (binsha, crc32,
+    offset) tuples."""
+    entries = sorted(entries)
+    sha = hashlib.sha1()
+
+    def write(data):
+        f.write(data)
+        sha.update(data)
+
+    write(IDX_MAGIC + struct.pack(">I", 2))
+
+    fanout = [0] * 256
+    for binsha, _, _ in entries:
+        fanout[binsha[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+    write(struct.pack(">256I", *fanout))
+
+    for binsha, _, _ in entries:
+        write(binsha)
+    for _, crc, _ in entries:
+        write(struct.pack(">I", crc))
+
+    large = list()
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            write(struct.pack(">I", offset))
+        else:
+            write(struct.pack(">I", 0x80000000 | len(large)))
+            large.append(offset)
+    for offset in large:
+        write(struct.pack(">Q", offset))
+
+    write(pack_checksum)
+    f.write(sha.digest())
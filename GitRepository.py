@@ -3,9 +3,66 @@ import sys
 import configparser
 import zlib
 import collections
+import concurrent.futures
+import contextlib
+import datetime
+import heapq
+import itertools
 import re
+import stat
+import tempfile
 
-from GitObject import GitObject, GitBlob, GitCommit, GitTree
+import PerfTrace
+from GitObject import GitObject, GitBlob, GitCommit, GitTree, GitTag
+from GitObject import hash_files, inflate_stream
+from ObjectCache import ObjectCache
+from ObjectNames import ObjectNames
+
+# The packs, their bitmaps, the commit-graph and the index are imported
+# by the methods that use them, so that commands which never touch them,
+# such as init or show-ref, don't load them.
+
+
+def commit_date(commit):
+    """The committer timestamp of a GitCommit, as an int."""
+    committer = commit.kvlm.get(b"committer") or commit.kvlm[b"author"]
+    return int(committer[0].rsplit(b" ", 2)[1])
+
+
+def format_date(timestamp, tz):
+    """Format a git timestamp and "+hhmm" timezone like git log does."""
+    sign = -1 if tz.startswith("-") else 1
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone(sign * offset))
+    return date.strftime(f"%a %b {date.day} %H:%M:%S %Y {tz}")
+
+
+# Anything that may be an abbreviated or full object name.
+hash_re = re.compile(r"^[0-9A-Fa-f]{1,40}$")
+
+# Paint of the merge base walk: which side a commit was reached from, and
+# whether it is already known to be an ancestor of a common commit.
+PARENT1, PARENT2, STALE = 1, 2, 4
+
+
+def fsync_path(path):
+    """Flush the file or directory at path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_worker_repo = None
+
+
+def worker_repo(path):
+    """The repository at path, opened once per worker process."""
+    global _worker_repo
+    if _worker_repo is None or _worker_repo.worktree != path:
+        _worker_repo = GitRepository(path)
+    return _worker_repo
 
 
 class GitRepository:
@@ -17,6 +74,12 @@ class GitRepository:
 
     def __init__(self, path, force=False):
         self.worktree = path
+        self._packs = None
+        self._pack_bitmap = None
+        self._commit_graph = None
+        self.names = ObjectNames(self)
+        self._ref_cache = dict()
+        self._packed_refs = None
         self.gitdir = os.path.join(path, ".git")
 
         if not (force or os.path.isdir(self.gitdir)):
@@ -36,6 +99,43 @@ class GitRepository:
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion {vers}")
 
+        # Parsed objects cache.  core.wyagCacheTypes can restrict it to
+        # a comma-separated list of object types, eg "commit,tree".
+        fmts = self.conf.get("core", "wyagCacheTypes", fallback=None)
+        if fmts is not None:
+            fmts = {f.strip().encode() for f in fmts.split(",") if f.strip()}
+        self.cache = ObjectCache(
+            self.config_size("core", "wyagCacheSize", 32 * 1024 * 1024), fmts
+        )
+        PerfTrace.watch("object cache", self.cache)
+
+        # Loose object writes.  core.looseCompression overrides
+        # core.compression, and both default to zlib's default level.
+        self.compression = int(
+            self.conf.get(
+                "core",
+                "looseCompression",
+                fallback=self.conf.get("core", "compression", fallback="-1"),
+            )
+        )
+        self.fsync_objects = self.conf.getboolean(
+            "core", "fsyncObjectFiles", fallback=False
+        )
+        self._batch = None
+
+    def config_size(self, section, option, default):
+        """Read a size from the configuration, accepting git's k, m and g
+        suffixes."""
+        value = self.conf.get(section, option, fallback=None)
+        if value is None:
+            return default
+
+        value = value.strip().lower()
+        units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+
     def repo_path(self, *path):
         """Compute path under repo's gitdir."""
         return os.path.join(self.gitdir, *path)
@@ -60,7 +160,8 @@ class GitRepository:
                 raise Exception(f"Not a directory {path}")
 
         if mkdir:
-            os.makedirs(path)
+            # Another thread writing objects may get there first.
+            os.makedirs(path, exist_ok=True)
             return path
         else:
             return None
@@ -69,39 +170,640 @@ class GitRepository:
         """Read object object_id from Git repository repo.  Return a
         GitObject whose exact type depends on the object."""
 
-        path = self.repo_file("objects", sha[0:2], sha[2:])
-
+        obj = self.cache.get(sha)
+        if obj is not None:
+            return obj
+
+        fmt, data = self.object_read_raw(sha)
+
+        # Pick constructor
+        if fmt == b"commit":
+            c = GitCommit
+        elif fmt == b"tree":
+            c = GitTree
+        elif fmt == b"tag":
+            c = GitTag
+        elif fmt == b"blob":
+            c = GitBlob
+        else:
+            raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+
+        # Call constructor, cache and return object
+        obj = c(self, data)
+        obj.frozen = True
+        self.cache.put(sha, obj, len(data))
+        return obj
+
+    def object_path(self, sha):
+        """The path of loose object sha, or None if there is none.  While
+        a batch is open, objects written in it live in temporary files."""
+        if self._batch and sha in self._batch:
+            return self._batch[sha]
+        path = self.repo_path("objects", sha[0:2], sha[2:])
+        return path if os.path.exists(path) else None
+
+    def object_read_raw(self, sha):
+        """Return the type and raw content of object sha, looking first
+        at loose objects, then inside packfiles."""
+
+        path = self.object_path(sha)
+        if path:
+            return self.object_read_loose(sha, path)
+
+        binsha = bytes.fromhex(sha)
+        for pack in self.packs():
+            ret = pack.read(binsha)
+            if ret:
+                return ret
+
+        raise Exception(f"No such object {sha}")
+
+    def object_read_loose(self, sha, path):
         with open(path, "rb") as f:
-            raw = zlib.decompress(f.read())
+            data = f.read()
+        raw = zlib.decompress(data)
+        if PerfTrace.enabled:
+            PerfTrace.count("loose inflate", len(data), len(raw))
+
+        # Read object type
+        x = raw.find(b" ")
+        fmt = raw[0:x]
+
+        # Read and validate object size
+        y = raw.find(b"\x00", x)
+        size = int(raw[x:y].decode("ascii"))
+        if size != len(raw) - y - 1:
+            raise Exception(f"Malformed object {sha}: bad length")
+
+        return fmt, raw[y + 1 :]
+
+    def object_exists(self, sha):
+        if self.object_path(sha):
+            return True
+        binsha = bytes.fromhex(sha)
+        return any(binsha in pack for pack in self.packs())
+
+    def object_info(self, sha):
+        """Return the type and size of object sha, reading as little of it
+        as possible."""
+        path = self.object_path(sha)
+        if path:
+            with open(path, "rb") as f:
+                head = b""
+                for chunk in inflate_stream(f.read, 64):
+                    head += chunk
+                    if b"\x00" in head:
+                        break
+            x = head.find(b" ")
+            y = head.find(b"\x00", x)
+            if x < 0 or y < 0:
+                raise Exception(f"Malformed object {sha}: bad header")
+            return head[0:x], int(head[x:y].decode("ascii"))
+
+        binsha = bytes.fromhex(sha)
+        for pack in self.packs():
+            ret = pack.info(binsha)
+            if ret:
+                return ret
+
+        raise Exception(f"No such object {sha}")
+
+    def object_open(self, sha):
+        """Open object sha for streaming.  Return its type, its size and
+        an iterator over its contents, in chunks of bounded size."""
+
+        path = self.object_path(sha)
+        if path:
+            return self.object_open_loose(sha, path)
+
+        binsha = bytes.fromhex(sha)
+        for pack in self.packs():
+            ret = pack.stream(binsha)
+            if ret:
+                return ret
+
+        raise Exception(f"No such object {sha}")
+
+    def object_open_loose(self, sha, path):
+        # Only the header is inflated here, a few bytes at a time.  The
+        # reader opens the file again itself, so that a stream which is
+        # never read holds no file open.
+        with open(path, "rb") as f:
+            d = zlib.decompressobj()
+            head = b""
+            while b"\x00" not in head and not d.eof:
+                data = d.unconsumed_tail or f.read(4096)
+                if not data:
+                    break
+                head += d.decompress(data, 64)
+
+        x = head.find(b" ")
+        y = head.find(b"\x00", x)
+        if x < 0 or y < 0:
+            raise Exception(f"Malformed object {sha}: bad header")
+        fmt = head[0:x]
+        size = int(head[x:y].decode("ascii"))
+
+        def reader():
+            with open(path, "rb") as f:
+                skip = y + 1
+                total = 0
+                for chunk in inflate_stream(f.read):
+                    if skip:
+                        n = min(skip, len(chunk))
+                        chunk, skip = chunk[n:], skip - n
+                    total += len(chunk)
+                    if chunk:
+                        yield chunk
+            if total != size:
+                raise Exception(f"Malformed object {sha}: bad length")
 
-            # Read object type
-            x = raw.find(b" ")
-            fmt = raw[0:x]
+        return fmt, size, reader()
 
-            # Read and validate object size
-            y = raw.find(b"\x00", x)
-            size = int(raw[x:y].decode("ascii"))
-            if size != len(raw) - y - 1:
-                raise Exception(f"Malformed object {sha}: bad length")
+    def object_install(self, sha, tmp_path):
+        """Move the complete temporary file tmp_path into place as loose
+        object sha.  Within a batch, this is deferred to the batch end."""
+        if self._batch is not None:
+            if self._batch.setdefault(sha, tmp_path) != tmp_path:
+                # Another thread of the batch wrote the same object.
+                os.remove(tmp_path)
+            else:
+                self.names.add(sha)
+            return
+
+        path = self.repo_file("objects", sha[0:2], sha[2:], mkdir=True)
+        os.chmod(tmp_path, 0o444)
+        os.rename(tmp_path, path)
+        self.names.add(sha)
+        if self.fsync_objects:
+            fsync_path(os.path.dirname(path))
+
+    def object_fsync(self, f):
+        """Flush the object file f to disk, if durability asks for it
+        now rather than at the end of a batch."""
+        if self.fsync_objects and self._batch is None:
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextlib.contextmanager
+    def object_batch(self):
+        """Group object writes for durability at a lower cost: objects
+        are written to temporary files without syncing, and when the
+        block ends, those files are synced all together, in parallel,
+        before they are moved into place and their directories synced.
+        A crash can lose the batch, but never leaves a truncated object
+        behind.
+
+        Without core.fsyncObjectFiles there is nothing to defer, and this
+        does nothing."""
+        if self._batch is not None or not self.fsync_objects:
+            yield
+            return
+
+        self._batch = dict()
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            if batch:
+                # Only the files of the batch are synced, not the whole
+                # system's dirty pages as sync() would.
+                with concurrent.futures.ThreadPoolExecutor() as pool:
+                    list(pool.map(fsync_path, batch.values()))
+                dirs = set()
+                for sha, tmp_path in batch.items():
+                    path = self.repo_file("objects", sha[0:2], sha[2:], mkdir=True)
+                    os.chmod(tmp_path, 0o444)
+                    os.rename(tmp_path, path)
+                    dirs.add(os.path.dirname(path))
+                for path in sorted(dirs):
+                    fsync_path(path)
+
+    def packs(self):
+        """The packfiles of this repository, opened on first use."""
+        if self._packs is None:
+            from GitPack import pack_list
+
+            self._packs = pack_list(self.repo_dir("objects", "pack"), self)
+        return self._packs
+
+    def packs_reload(self):
+        """Forget the opened packs, so that packs() sees new ones."""
+        for pack in self._packs or []:
+            pack.close()
+        self._packs = None
+        self._pack_bitmap = None
+
+    def loose_objects(self):
+        """Yield the SHA of every loose object."""
+        objects = self.repo_dir("objects")
+        for prefix in sorted(os.listdir(objects)):
+            if len(prefix) != 2:
+                continue
+            for f in sorted(os.listdir(os.path.join(objects, prefix))):
+                if len(f) == 38:
+                    yield prefix + f
+
+    def object_walk(self, roots, hidden=()):
+        """Yield (sha, fmt, path) for every object reachable from roots,
+        commits and tags first, then trees and blobs.  Blobs are never
+        read: their type is known from the tree entry that names them.
+        Objects in hidden, and what is only reachable through them, are
+        left out."""
+        seen = set(hidden)
+        trees = list()
+
+        stack = list(reversed(roots))
+        while stack:
+            sha = stack.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+
+            obj = self.object_read(sha)
+            if obj.fmt == b"tree":
+                # A tag or ref can point straight at a tree.
+                seen.remove(sha)
+                trees.append((sha, b""))
+                continue
 
-            # Pick constructor
-            if fmt == b"commit":
-                c = GitCommit
-            elif fmt == b"tree":
-                c = GitTree
-            elif fmt == b"tag":
-                c = GitTag
-            elif fmt == b"blob":
-                c = GitBlob
+            if obj.fmt == b"tag":
+                # Tags go by their name, as in git rev-list --objects.
+                yield sha, obj.fmt, obj.kvlm.get(b"tag", [b""])[0]
+                stack.append(obj.kvlm[b"object"][0].decode("ascii"))
+            elif obj.fmt == b"commit":
+                yield sha, obj.fmt, b""
+                trees.append((obj.kvlm[b"tree"][0].decode("ascii"), b""))
+                for parent in reversed(obj.kvlm.get(b"parent", [])):
+                    stack.append(parent.decode("ascii"))
             else:
-                raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+                yield sha, obj.fmt, b""
+
+        trees.reverse()
+        while trees:
+            sha, path = trees.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+
+            tree = self.object_read(sha)
+            yield sha, b"tree", path
+
+            for item in reversed(tree.items):
+                if item.mode == b"160000":
+                    # Submodule: the commit lives in another repository.
+                    continue
+                item_path = path + b"/" + item.path if path else item.path
+                if item.mode.startswith(b"4"):
+                    trees.append((item.sha, item_path))
+                elif item.sha not in seen:
+                    seen.add(item.sha)
+                    yield item.sha, b"blob", item_path
+
+    def repack(self, window=10, depth=50, prune=True, bitmap=None):
+        """Write every reachable object to a single new pack.  If prune,
+        delete the loose objects and the older packs it makes redundant.
+        If bitmap, or if it is None and repack.writeBitmaps is set, also
+        write reachability bitmaps for the pack.  Return the path of the
+        new pack index, or None if there was nothing to pack."""
+        from GitPack import GitPack, GitPackIndex, GitPackWriter
+
+        objects = list(self.object_walk(self.ref_roots()))
+        if not objects:
+            return None
+
+        # Group objects by type, then by file name, so that the delta
+        # window sees successive versions of the same file together.
+        # The sort is stable, so newer versions come first and older
+        # ones get stored as deltas against them.
+        order = {b"commit": 0, b"tag": 1, b"tree": 2, b"blob": 3}
+        objects.sort(key=lambda o: (order[o[1]], os.path.basename(o[2]), o[2]))
+
+        pack_dir = self.repo_dir("objects", "pack", mkdir=True)
+        writer = GitPackWriter(pack_dir, len(objects), window=window, depth=depth)
+        try:
+            for sha, fmt, _ in objects:
+                data = self.object_read_raw(sha)[1]
+                writer.add(sha, fmt, data)
+            idx_path = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+        if bitmap is None:
+            bitmap = self.conf.getboolean("repack", "writeBitmaps", fallback=False)
+        if bitmap:
+            self.bitmap_write(idx_path, objects)
+
+        old_indexes = [p.index.path for p in self.packs() if p.index.path != idx_path]
+        self.packs_reload()
+
+        if prune:
+            new_pack = GitPack(self, idx_path)
+            self.prune_packed(new_pack)
+            for path in old_indexes:
+                if os.path.exists(path[:-4] + ".keep"):
+                    continue
+                index = GitPackIndex(path)
+                redundant = all(sha in new_pack for sha, _ in index)
+                index.close()
+                if redundant:
+                    os.remove(path[:-4] + ".pack")
+                    os.remove(path)
+                    if os.path.exists(path[:-4] + ".bitmap"):
+                        os.remove(path[:-4] + ".bitmap")
+            new_pack.close()
+
+        return idx_path
+
+    def prune_packed(self, pack):
+        """Delete the loose objects that are also stored in pack."""
+        for sha in list(self.loose_objects()):
+            if bytes.fromhex(sha) in pack:
+                os.remove(self.repo_path("objects", sha[0:2], sha[2:]))
+
+        objects = self.repo_dir("objects")
+        for prefix in os.listdir(objects):
+            path = os.path.join(objects, prefix)
+            if len(prefix) == 2 and not os.listdir(path):
+                os.rmdir(path)
+
+        self.names.reset()
+
+    def pack_bitmap(self):
+        """The reachability bitmaps of the first pack that has some, opened
+        on first use, or None."""
+        if self._pack_bitmap is None:
+            from PackBitmap import PackBitmap
+
+            self._pack_bitmap = False
+            for pack in self.packs():
+                path = pack.path[:-5] + ".bitmap"
+                if os.path.exists(path):
+                    self._pack_bitmap = PackBitmap(pack, path)
+                    break
+        return self._pack_bitmap or None
+
+    def bitmap_write(self, idx_path, objects):
+        """Write the .bitmap file of the pack at idx_path, which holds
+        objects, a list of (sha, fmt, path) closed under reachability.
+
+        Ref tips get a bitmap, and so does one commit in every
+        SELECT_INTERVAL, so that a walk from anywhere soon meets one.  They
+        are computed oldest first, each walk stopping at the bitmaps that
+        are already known."""
+        from GitPack import GitPack
+        from PackBitmap import PackBitmap, SELECT_INTERVAL, pack_bitmap_write
+
+        pack = GitPack(self, idx_path)
+        try:
+            bitmap = PackBitmap(pack)
+            types = collections.defaultdict(lambda: bytearray((len(bitmap) + 7) // 8))
+            for sha, fmt, _ in objects:
+                pos = bitmap.position(bytes.fromhex(sha))
+                types[fmt][pos >> 3] |= 1 << (pos & 7)
+            types = {fmt: int.from_bytes(b, "little") for fmt, b in types.items()}
+
+            tips = set()
+            for sha in self.ref_roots():
+                obj = self.object_read(sha)
+                while obj.fmt == b"tag":
+                    sha = obj.kvlm[b"object"][0].decode("ascii")
+                    obj = self.object_read(sha)
+                if obj.fmt == b"commit":
+                    tips.add(sha)
+            commits = [sha for sha, fmt, _ in objects if fmt == b"commit"]
+            selected = tips.union(commits[::SELECT_INTERVAL])
+            meta = self.commit_metas()
+            selected = sorted(selected, key=lambda sha: meta(sha)[1])
+
+            known = dict()
+            entries = list()
+            for sha in selected:
+                bits, extra = self.bitmap_reach(bitmap, [sha], known.get)
+                if extra:
+                    raise Exception(f"Pack {pack.path} misses objects of {sha}")
+                binsha = bytes.fromhex(sha)
+                known[bitmap.position(binsha)] = bits
+                entries.append((pack.index.bisect(binsha), bits))
+
+            pack_dir = os.path.dirname(idx_path)
+            fd, tmp_path = tempfile.mkstemp(prefix="tmp_bitmap_", dir=pack_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pack_bitmap_write(f, pack.map[-20:], len(bitmap), types, entries)
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, idx_path[:-4] + ".bitmap")
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        finally:
+            pack.close()
+        self._pack_bitmap = None
+
+    def bitmap_reach(self, bitmap, starts, known=None):
+        """Return the objects reachable from starts, as a bitmap over the
+        pack of bitmap, and a dict mapping the SHA of those that aren't in
+        the pack to their type.  The walk doesn't go past the commits that
+        known, by default bitmap.bitmap, has a bitmap for: it takes their
+        bitmap instead.  Trees already in the result aren't read again."""
+        if known is None:
+            known = bitmap.bitmap
+        found = bytearray((len(bitmap) + 7) // 8)
+        extra = dict()
+
+        def mark(sha, fmt):
+            """Add sha to the result; return its pack position, or -1 if it
+            isn't in the pack, or None if it was already there."""
+            pos = bitmap.position(bytes.fromhex(sha))
+            if pos is None:
+                if sha in extra:
+                    return None
+                extra[sha] = fmt
+                return -1
+            if found[pos >> 3] & 1 << (pos & 7):
+                return None
+            found[pos >> 3] |= 1 << (pos & 7)
+            return pos
+
+        trees = list()
+        stack = list(starts)
+        while stack:
+            sha = stack.pop()
+            obj = self.object_read(sha)
+            if obj.fmt == b"tree":
+                trees.append(sha)
+                continue
+            pos = mark(sha, obj.fmt)
+            if pos is None:
+                continue
 
-            # Call constructor and return object
-            return c(self, raw[y + 1 :])
+            if obj.fmt == b"tag":
+                stack.append(obj.kvlm[b"object"][0].decode("ascii"))
+            elif obj.fmt == b"commit":
+                bits = known(pos) if pos >= 0 else None
+                if bits is not None:
+                    # Merging is linear in the size of the pack, but
+                    # saves walking the whole history below this commit.
+                    bits |= int.from_bytes(found, "little")
+                    found[:] = bits.to_bytes(len(found), "little")
+                    continue
+                trees.append(obj.kvlm[b"tree"][0].decode("ascii"))
+                stack.extend(p.decode("ascii") for p in obj.kvlm.get(b"parent", []))
+
+        while trees:
+            sha = trees.pop()
+            if mark(sha, b"tree") is None:
+                continue
+            for item in self.object_read(sha).items:
+                if item.mode.startswith(b"4"):
+                    trees.append(item.sha)
+                elif item.mode != b"160000":
+                    mark(item.sha, b"blob")
+
+        return int.from_bytes(found, "little"), extra
+
+    def rev_list(self, starts, excludes=(), objects=False, use_bitmap=False):
+        """Yield (sha, fmt, path) for the commits reachable from starts but
+        not from excludes, newest first, then if objects, for their trees
+        and blobs too.  Each tree is only read once.
+
+        With use_bitmap, and reachability bitmaps to use, the answer comes
+        from set operations on them instead, in pack order, and without
+        paths."""
+        reach = self.rev_list_bitmap(starts, excludes, objects) if use_bitmap else None
+        if reach:
+            bitmap, bits, extra = reach
+            for binsha, fmt in bitmap.objects(bits):
+                yield binsha.hex(), fmt, b""
+            for sha, fmt in extra.items():
+                yield sha, fmt, b""
+        elif objects:
+            hidden = set(sha for sha, _, _ in self.object_walk(excludes))
+            yield from self.object_walk(starts, hidden)
+        else:
+            hidden = set(sha for sha, _ in self.rev_walk(excludes))
+            for sha, _ in self.rev_walk(starts, hidden=hidden):
+                yield sha, b"commit", b""
+
+    def rev_list_bitmap(self, starts, excludes=(), objects=False):
+        """Return (bitmap, bits, extra) for rev_list(), as bitmap_reach()
+        does, or None if there is no bitmap."""
+        bitmap = self.pack_bitmap()
+        if not bitmap:
+            return None
+
+        bits, extra = self.bitmap_reach(bitmap, starts)
+        if excludes:
+            hidden, hidden_extra = self.bitmap_reach(bitmap, excludes)
+            bits &= ~hidden
+            extra = {sha: fmt for sha, fmt in extra.items() if sha not in hidden_extra}
+        if not objects:
+            bits &= bitmap.types[b"commit"]
+            extra = {sha: fmt for sha, fmt in extra.items() if fmt == b"commit"}
+        return bitmap, bits, extra
+
+    def rev_list_count(self, starts, excludes=(), objects=False, use_bitmap=False):
+        """The number of objects rev_list() would yield."""
+        reach = self.rev_list_bitmap(starts, excludes, objects) if use_bitmap else None
+        if reach:
+            _, bits, extra = reach
+            return bits.bit_count() + len(extra)
+        return sum(1 for _ in self.rev_list(starts, excludes, objects))
+
+    def fsck(self, jobs=None, batch=256):
+        """Check every loose and packed object, and that all that HEAD,
+        the refs and the index lead to is there.  Return (corrupt,
+        missing, dangling): (sha, error) for each damaged object, and
+        (fmt, sha) for each object that is named but absent, and for
+        each one present that nothing names.
+
+        Objects are inflated, hashed and parsed in batches across jobs
+        processes: that work is mostly pure Python, which threads would
+        run one at a time."""
+        import GitFsck
+
+        tasks = list()
+        loose = list(self.loose_objects())
+        for i in range(0, len(loose), batch):
+            tasks.append((GitFsck.check_loose, self.worktree, loose[i : i + batch]))
+        for pack in self.packs():
+            # In offset order, so that delta bases tend to be at hand.
+            entries = sorted(pack.index, key=lambda entry: entry[1])
+            for i in range(0, len(entries), batch):
+                chunk = entries[i : i + batch]
+                tasks.append(
+                    (GitFsck.check_packed, self.worktree, pack.index.path, chunk)
+                )
+
+        corrupt = list()
+        jobs = jobs or os.cpu_count() or 1
+        if jobs == 1:
+            results = [fn(*args) for fn, *args in tasks]
+            errors = [GitFsck.check_pack_checksum(p.path) for p in self.packs()]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                futures = [pool.submit(*task) for task in tasks]
+                errors = pool.map(
+                    GitFsck.check_pack_checksum, [p.path for p in self.packs()]
+                )
+                results = [f.result() for f in futures]
+                errors = list(errors)
+        corrupt += [(None, error) for error in errors if error]
+
+        types = dict()
+        links = dict()
+        for good, bad in results:
+            for sha, fmt, named in good:
+                types[sha] = fmt
+                links[sha] = named
+            corrupt += bad
+        # A damaged copy of an object doesn't matter if another is sound.
+        corrupt = [(sha, error) for sha, error in corrupt if sha not in types]
+        damaged = set(sha for sha, _ in corrupt)
+
+        missing = dict()
+        named = set()
+        for sha, targets in links.items():
+            for fmt, target in targets:
+                named.add(target)
+                if target not in types:
+                    if target not in damaged:
+                        missing[target] = fmt
+                elif types[target] != fmt:
+                    actual = types[target].decode()
+                    error = f"names {target} as a {fmt.decode()}, not a {actual}"
+                    corrupt.append((sha, error))
+
+        # Refs may name any type of object, the index only blobs.
+        stack = [(b"object", sha) for sha in self.ref_roots()]
+        index = self.index_read()
+        stack += [
+            (b"blob", index.sha(i))
+            for i in range(len(index))
+            if index.mode(i) != 0o160000
+        ]
+        reachable = set()
+        while stack:
+            fmt, sha = stack.pop()
+            if sha in reachable:
+                continue
+            reachable.add(sha)
+            if sha in types:
+                stack.extend(links[sha])
+            elif sha not in damaged:
+                missing.setdefault(sha, fmt)
+
+        dangling = [
+            (types[sha], sha)
+            for sha in sorted(types)
+            if sha not in named and sha not in reachable
+        ]
+        missing = [(fmt, sha) for sha, fmt in sorted(missing.items())]
+        return corrupt, missing, dangling
 
     def object_resolve(self, name):
         candidates = list()
-        hash_re = re.compile(r"^[0-9A-Fa-f]{1,16}$")
 
         # Empty string?  Abort.
         if not name.strip():
@@ -109,7 +811,15 @@ class GitRepository:
 
         # Head is nonambiguous
         if name == "HEAD":
-            return [self.ref_resolve("HEAD")]
+            head = self.ref_resolve("HEAD")
+            return [head] if head else []
+
+        # Then refs, looked up in the same order as git does.
+        for ref in (name, "refs/" + name, "refs/tags/" + name, "refs/heads/" + name):
+            if ref.startswith("refs/"):
+                sha = self.ref_resolve(ref)
+                if sha:
+                    return [sha]
 
         if hash_re.match(name):
             if len(name) == 40:
@@ -119,17 +829,14 @@ class GitRepository:
                 # This is a small hash 4 seems to be the minimal length
                 # for git to consider something a short hash.
                 # This limit is documented in man git-rev-parse
-                name = name.lower()
-                prefix = name[0:2]
-                path = self.repo_dir("objects", prefix, mkdir=False)
-                if path:
-                    rem = name[2:]
-                    for f in os.listdir(path):
-                        if f.startswith(rem):
-                            candidates.append(prefix + f)
+                candidates = self.names.find(name)
 
         return candidates
 
+    def object_abbrev(self, sha, min_length=7):
+        """The shortest unambiguous abbreviation of sha."""
+        return self.names.abbrev(sha, min_length)
+
     def object_find(self, name, fmt=None, follow=True):
         sha = self.object_resolve(name)
 
@@ -158,88 +865,1136 @@ class GitRepository:
 
             # Follow tags
             if obj.fmt == b"tag":
-                sha = obj.kvlm[b"object"].decode("ascii")
+                sha = obj.kvlm[b"object"][0].decode("ascii")
             elif obj.fmt == b"commit" and fmt == b"tree":
-                sha = obj.kvlm[b"tree"].decode("ascii")
+                sha = obj.kvlm[b"tree"][0].decode("ascii")
             else:
                 return None
-            return name
 
     def cat_file(self, obj, fmt=None):
-        obj = self.object_read(self.object_find(obj, fmt=fmt))
-        sys.stdout.buffer.write(obj.serialize())
-
-    def log_graphviz(self, sha, seen=None):
-
-        seen = seen or set()
+        _, _, chunks = self.object_open(self.object_find(obj, fmt=fmt))
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+
+    def cat_file_batch(self, names, out, contents=True, flush=False):
+        """For each object name in names, write a "<sha> <type> <size>"
+        line to out, followed by the contents and a newline if contents.
+        Unknown names get a "<name> missing" line instead, and ambiguous
+        ones "<name> ambiguous".  out is only flushed after each record
+        if flush is set."""
+        for name in names:
+            name = name.strip().decode("utf-8", "replace")
+            if not name:
+                continue
+
+            candidates = self.object_resolve(name)
+            if candidates and len(candidates) > 1:
+                out.write(f"{name} ambiguous\n".encode())
+            elif not candidates or not self.object_exists(candidates[0]):
+                out.write(f"{name} missing\n".encode())
+            elif contents:
+                sha = candidates[0]
+                fmt, size, chunks = self.object_open(sha)
+                out.write(f"{sha} {fmt.decode()} {size}\n".encode())
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b"\n")
+            else:
+                sha = candidates[0]
+                fmt, size = self.object_info(sha)
+                out.write(f"{sha} {fmt.decode()} {size}\n".encode())
+
+            if flush:
+                out.flush()
+        out.flush()
+
+    def rev_walk(self, starts, order="date", since=None, hidden=()):
+        """Yield (sha, parents) for every commit reachable from the
+        commits in starts, newest first.  order is either "date", for
+        reverse commit date order, or "topo", which additionally never
+        shows a commit before all of its children.  Commits older than
+        the since timestamp, and their history, are left out, as are the
+        commits in hidden and what is only reachable through them.
+
+        This is a generator: output can begin, and stop, long before
+        the whole history has been visited."""
+        if order == "topo":
+            yield from self.rev_walk_topo(starts, since, hidden)
+            return
 
-        if sha in seen:
+        heap = list()
+        seen = set(hidden)
+        counter = itertools.count()
+
+        def push(sha):
+            if sha in seen:
+                return
+            seen.add(sha)
+            parents, date, _ = self.commit_meta(sha)
+            if since is None or date >= since:
+                heapq.heappush(heap, (-date, next(counter), sha, parents))
+
+        for sha in starts:
+            push(sha)
+
+        while heap:
+            _, _, sha, parents = heapq.heappop(heap)
+            yield sha, parents
+            for parent in parents:
+                push(parent)
+
+    def rev_walk_topo(self, starts, since=None, hidden=()):
+        graph = self.commit_graph()
+        if graph and all(graph.position(bytes.fromhex(s)) is not None for s in starts):
+            # Generation numbers are always higher for children than for
+            # their parents, so ordering by them is a topological order,
+            # and we can still stream.  Ancestors of graphed commits are
+            # all in the graph too.
+            heap = list()
+            seen = set(hidden)
+
+            def push(sha):
+                if sha in seen:
+                    return
+                seen.add(sha)
+                parents, date, generation = self.commit_meta(sha)
+                if since is None or date >= since:
+                    heapq.heappush(heap, (-generation, -date, sha, parents))
+
+            for sha in starts:
+                push(sha)
+
+            while heap:
+                _, _, sha, parents = heapq.heappop(heap)
+                yield sha, parents
+                for parent in parents:
+                    push(parent)
             return
-        seen.add(sha)
 
-        commit = self.object_read(sha)
-        assert commit.fmt == b"commit"
+        # Without generation numbers we have to see every commit first,
+        # to count how many children each one has.
+        metas = dict()
+        children = collections.Counter()
+        stack = list(starts)
+        while stack:
+            sha = stack.pop()
+            if sha in metas or sha in hidden:
+                continue
+            parents, date, _ = self.commit_meta(sha)
+            if since is not None and date < since:
+                continue
+            metas[sha] = (parents, date)
+            for parent in parents:
+                children[parent] += 1
+                stack.append(parent)
+
+        heap = [
+            (-metas[s][1], s) for s in set(starts) if s in metas and not children[s]
+        ]
+        heapq.heapify(heap)
+        while heap:
+            _, sha = heapq.heappop(heap)
+            parents = metas[sha][0]
+            yield sha, parents
+            for parent in parents:
+                children[parent] -= 1
+                if not children[parent] and parent in metas:
+                    heapq.heappush(heap, (-metas[parent][1], parent))
+
+    def commit_metas(self):
+        """A memoized commit_meta, for walks that look at the same
+        commits more than once."""
+        metas = dict()
+
+        def meta(sha):
+            m = metas.get(sha)
+            if m is None:
+                m = metas[sha] = self.commit_meta(sha)
+            return m
+
+        return meta
+
+    def paint_down(self, one, twos, meta, min_generation=0, until=None):
+        """Walk down from one and from the commits in twos at once, newest
+        first, painting each commit with the sides it can be reached from.
+        Commits reached from both sides are common ancestors, and their
+        history is painted stale; the walk stops as soon as only stale
+        commits are left to visit, or with generation numbers, when it gets
+        below min_generation, or once until has been reached from twos.
+
+        Return the common commits that weren't found to be ancestors of
+        others, in the order they were found, and the paint."""
+        paint = collections.defaultdict(int)
+        heap = list()
+        counter = itertools.count()
+        # How many times each commit is queued, and how many of the queued
+        # commits aren't stale, for the stop condition.
+        queued = collections.Counter()
+        fresh = 0
+
+        def push(sha):
+            nonlocal fresh
+            _, date, generation = meta(sha)
+            if generation is None:
+                generation = float("inf")
+            if not queued[sha] and not paint[sha] & STALE:
+                fresh += 1
+            queued[sha] += 1
+            heapq.heappush(heap, (-generation, -date, next(counter), sha))
+
+        def add_paint(sha, flags):
+            nonlocal fresh
+            if queued[sha] and flags & STALE and not paint[sha] & STALE:
+                fresh -= 1
+            paint[sha] |= flags
+
+        add_paint(one, PARENT1)
+        push(one)
+        for two in twos:
+            add_paint(two, PARENT2)
+            push(two)
+
+        results = list()
+        while fresh:
+            generation, _, _, sha = heapq.heappop(heap)
+            queued[sha] -= 1
+            if not queued[sha] and not paint[sha] & STALE:
+                fresh -= 1
+            if -generation < min_generation:
+                break
+
+            flags = paint[sha]
+            if flags & (PARENT1 | PARENT2) == PARENT1 | PARENT2:
+                if not flags & STALE and sha not in results:
+                    results.append(sha)
+                flags |= STALE
+            for parent in meta(sha)[0]:
+                if paint[parent] & flags == flags:
+                    continue
+                add_paint(parent, flags)
+                push(parent)
+            if until is not None and paint[until] & PARENT2:
+                break
+
+        return [sha for sha in results if not paint[sha] & STALE], paint
+
+    def merge_base(self, one, twos):
+        """Return the best common ancestors of commit one and the commits
+        in twos: those that aren't an ancestor of another.  Most recent
+        first.  As in git, with more than one commit in twos, this is the
+        merge base of one and a merge of all of twos."""
+        meta = self.commit_metas()
+        candidates, _ = self.paint_down(one, twos, meta)
+        candidates.sort(key=lambda sha: meta(sha)[1], reverse=True)
+        if len(candidates) < 2:
+            return candidates
+
+        # With commit dates alone, clock skew can let an ancestor of
+        # another candidate through.  Drop those.
+        return [
+            c
+            for c in candidates
+            if not any(
+                self.is_ancestor(c, other, meta) for other in candidates if other != c
+            )
+        ]
+
+    def is_ancestor(self, one, two, meta=None):
+        """Whether commit one is an ancestor of commit two, or two itself."""
+        if one == two:
+            return True
+        if meta is None:
+            meta = self.commit_metas()
+        # Nothing below one's generation can lead to it.
+        generation = meta(one)[2] or 0
+        _, paint = self.paint_down(one, [two], meta, generation, until=one)
+        return bool(paint[one] & PARENT2)
+
+    def log_graphviz(self, commits):
+        print("digraph wyaglog{")
+        for sha, parents in commits:
+            for parent in parents:
+                print(f"c_{sha} -> c_{parent};")
+        print("}")
+
+    def log_oneline(self, commits):
+        for sha, _ in commits:
+            message = self.object_read(sha).kvlm[b""][0]
+            subject = message.split(b"\n", 1)[0].decode("utf-8", "replace")
+            print(f"{sha[:7]} {subject}")
+
+    def log_medium(self, commits):
+        for sha, parents in commits:
+            commit = self.object_read(sha)
+            print(f"commit {sha}")
+            if len(parents) > 1:
+                print("Merge: " + " ".join(p[:7] for p in parents))
+
+            author = commit.kvlm[b"author"][0].decode("utf-8", "replace")
+            name, timestamp, tz = author.rsplit(" ", 2)
+            print(f"Author: {name}")
+            print(f"Date:   {format_date(int(timestamp), tz)}")
+            print()
+
+            message = commit.kvlm[b""][0].decode("utf-8", "replace")
+            for line in message.rstrip("\n").split("\n"):
+                print(f"    {line}" if line else "")
+            print()
+
+    def commit_graph(self):
+        """The commit-graph file, if there is one, opened on first use."""
+        if self._commit_graph is None:
+            from CommitGraph import CommitGraph
+
+            path = self.repo_path("objects", "info", "commit-graph")
+            self._commit_graph = CommitGraph(path) if os.path.exists(path) else False
+        return self._commit_graph or None
+
+    def commit_meta(self, sha):
+        """Return (parents, date, generation) for commit sha, from the
+        commit-graph if it knows about this commit, else by parsing the
+        commit.  generation is None when it isn't known."""
+        graph = self.commit_graph()
+        if graph:
+            pos = graph.position(bytes.fromhex(sha))
+            if pos is not None:
+                parents, generation, date = graph.commit(pos)
+                parents = [graph.oid(p).hex() for p in parents]
+                return parents, date, generation
 
-        if b"parent" not in commit.kvlm.keys():
-            # Base case: the initial commit.
-            return
+        commit = self.object_read(sha)
+        if commit.fmt != b"commit":
+            raise Exception(f"Not a commit {sha}")
+        parents = [p.decode("ascii") for p in commit.kvlm.get(b"parent", [])]
+        return parents, commit_date(commit), None
+
+    def commit_graph_write(self):
+        """Write objects/info/commit-graph for every commit reachable from
+        HEAD and the refs.  Return the number of commits it holds."""
+        from CommitGraph import commit_graph_write
+
+        commits = dict()
+        stack = list(self.ref_roots())
+        while stack:
+            sha = stack.pop()
+            binsha = bytes.fromhex(sha)
+            if binsha in commits:
+                continue
 
-        parents = commit.kvlm[b"parent"]
+            obj = self.object_read(sha)
+            if obj.fmt == b"tag":
+                stack.append(obj.kvlm[b"object"][0].decode("ascii"))
+                continue
+            if obj.fmt != b"commit":
+                continue
+
+            parents = obj.kvlm.get(b"parent", [])
+            commits[binsha] = (
+                bytes.fromhex(obj.kvlm[b"tree"][0].decode("ascii")),
+                [bytes.fromhex(p.decode("ascii")) for p in parents],
+                commit_date(obj),
+            )
+            stack.extend(p.decode("ascii") for p in parents)
+
+        info = self.repo_dir("objects", "info", mkdir=True)
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_graph_", dir=info)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                commit_graph_write(f, commits)
+            os.chmod(tmp_path, 0o444)
+            if self._commit_graph:
+                self._commit_graph.close()
+            os.rename(tmp_path, os.path.join(info, "commit-graph"))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self._commit_graph = None
+        return len(commits)
+
+    def diff_tree(self, old, new, recursive=False, base=b""):
+        """Yield (status, path, old_entry, new_entry) for every difference
+        between the trees old and new, either of which may be None for an
+        empty tree.  Status is A, D or M, and the missing entry of an
+        addition or deletion is None.
+
+        Both trees are walked side by side in their sorted order.  An
+        entry with the same mode and SHA on both sides is skipped without
+        being read, so only the subtrees that changed are ever looked at.
+        With recursive, those are reported as the changes inside them,
+        rather than as changed trees."""
+        a = old.items if old is not None else ()
+        b = new.items if new is not None else ()
+        i = j = 0
+        ea = eb = None
+        while True:
+            if ea is None and i < len(a):
+                ea = a[i]
+                ka = ea.sort_key()
+            if eb is None and j < len(b):
+                eb = b[j]
+                kb = eb.sort_key()
+            if ea is None and eb is None:
+                return
+
+            if eb is None or (ea is not None and ka < kb):
+                yield from self.diff_entry(base, ea, None, recursive)
+                ea = None
+                i += 1
+            elif ea is None or kb < ka:
+                yield from self.diff_entry(base, None, eb, recursive)
+                eb = None
+                j += 1
+            else:
+                if ea.binsha != eb.binsha or ea.mode != eb.mode:
+                    yield from self.diff_entry(base, ea, eb, recursive)
+                ea = eb = None
+                i += 1
+                j += 1
+
+    def diff_entry(self, base, old, new, recursive):
+        entry = old or new
+        path = base + entry.path
+        # Entries with the same sort key are either both trees or neither.
+        if recursive and entry.mode.startswith(b"4"):
+            yield from self.diff_tree(
+                self.object_read(old.sha) if old else None,
+                self.object_read(new.sha) if new else None,
+                recursive,
+                path + b"/",
+            )
+        elif old is None:
+            yield "A", path, None, new
+        elif new is None:
+            yield "D", path, old, None
+        else:
+            yield "M", path, old, new
 
-        for parent in parents:
-            parent = parent.decode("ascii")
-            print(f"c_{sha} -> c_{parent};")
-            self.log_graphviz(parent, seen)
+    def tree_checkout(self, tree, path, jobs=1):
+        """Checkout tree into the existing directory path.  With more
+        than one job, blobs are written from a pool of threads: zlib and
+        file I/O both release the GIL."""
+        if jobs > 1:
+            return self.tree_checkout_parallel(tree, path, jobs)
 
-    def tree_checkout(self, tree, path):
         for item in tree.items:
-            obj = self.object_read(item.sha)
             dest = os.path.join(path, item.path)
 
-            if obj.fmt == b"tree":
+            if item.mode.startswith(b"4"):
                 os.mkdir(dest)
-                self.tree_checkout(obj, dest)
-            elif obj.fmt == b"blob":
-                with open(dest, "wb") as f:
-                    f.write(obj.blobdata)
+                self.tree_checkout(self.object_read(item.sha), dest)
+            elif item.mode != b"160000":
+                self.blob_checkout(item.sha, dest)
+
+    def tree_checkout_parallel(self, tree, path, jobs):
+        # First create the whole directory skeleton, collecting the
+        # blobs to write on the way.
+        blobs = list()
+        stack = [(tree, path)]
+        while stack:
+            tree, path = stack.pop()
+            for item in tree.items:
+                dest = os.path.join(path, item.path)
+                if item.mode.startswith(b"4"):
+                    os.mkdir(dest)
+                    stack.append((self.object_read(item.sha), dest))
+                elif item.mode != b"160000":
+                    blobs.append((item.sha, dest))
+
+        # Then write the blobs.
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(self.blob_checkout, *blob) for blob in blobs]
+
+        # Report failures in path order, whatever order they happened in.
+        errors = sorted(
+            (dest, future.exception())
+            for (_, dest), future in zip(blobs, futures)
+            if future.exception()
+        )
+        if errors:
+            details = "\n - ".join(
+                f"{os.fsdecode(dest)}: {error}" for dest, error in errors
+            )
+            raise Exception(f"Checkout failed for {len(errors)} files:\n - {details}")
+
+    def tree_update(self, old, new, path, check=False):
+        """Update the directory path, which holds a checkout of tree old,
+        to tree new.  Only the paths that differ between the trees are
+        touched, and a file that merely moved is renamed, not written
+        again.  With check, nothing is done if any file to be changed or
+        deleted no longer matches old, or if a file to be added would
+        overwrite one that isn't tracked.  Return the number of files
+        (written, renamed, deleted)."""
+        removed = dict()
+        written = list()
+        for _, name, a, b in self.diff_tree(old, new, recursive=True):
+            # Submodules are not checked out, so they aren't there.
+            if a and a.mode == b"160000":
+                a = None
+            if b and b.mode == b"160000":
+                b = None
+            # Modes aren't applied by checkouts, so a change of mode alone
+            # leaves nothing to do.
+            if a and b and a.sha == b.sha:
+                continue
+            if a and not b:
+                removed[name] = a.sha
+            elif b:
+                written.append((name, a, b.sha))
+
+        # A file deleted here and added there with the same contents is a
+        # rename.
+        sources = collections.defaultdict(list)
+        for name, sha in removed.items():
+            sources[sha].append(name)
+        renamed = list()
+        added = list()
+        for name, a, sha in written:
+            if not a and sources.get(sha):
+                source = sources[sha].pop()
+                del removed[source]
+                renamed.append((source, name, sha))
+            else:
+                added.append((name, a, sha))
+        written = added
+
+        # Everything that could stop the update halfway is checked before
+        # anything is touched.
+        if check:
+            self.tree_update_check(path, removed, written, renamed)
+        gone = set(removed)
+        gone.update(source for source, _, _ in renamed)
+        created = [name for name, a, _ in written if not a]
+        created += [name for _, name, _ in renamed]
+        blocked = self.tree_update_blocked(path, gone, created)
+        if blocked:
+            names = "\n - ".join(os.fsdecode(name) for name in sorted(blocked))
+            raise Exception(f"Untracked files are in the way of:\n - {names}")
+
+        for name in removed:
+            os.remove(os.path.join(path, name))
+
+        # Sources are moved out of the way first, as a file may move into
+        # what was its own directory, or the other way round.
+        moving = None
+        if renamed:
+            moving = tempfile.mkdtemp(prefix=b".wyag-update-", dir=path)
+            for n, (source, _, _) in enumerate(renamed):
+                os.rename(os.path.join(path, source), os.path.join(moving, b"%d" % n))
+
+        # Directories emptied by deletions may be in the way of new files.
+        self.prune_dirs(path, gone)
+
+        if moving:
+            for n, (_, name, _) in enumerate(renamed):
+                os.rename(os.path.join(moving, b"%d" % n), self.update_dest(path, name))
+            os.rmdir(moving)
+
+        for name, _, sha in written:
+            self.blob_checkout(sha, self.update_dest(path, name))
+
+        return len(written), len(renamed), len(removed)
+
+    def tree_update_check(self, path, removed, written, renamed):
+        """Raise if tree_update would lose local changes."""
+        expected = list(removed.items())
+        expected += [(name, a.sha) for name, a, _ in written if a]
+        expected += [(source, sha) for source, _, sha in renamed]
+        conflicts = [
+            name
+            for name, sha in expected
+            if not self.file_matches(os.path.join(path, name), sha)
+        ]
+
+        # New files must not replace untracked ones.
+        added = [name for name, a, _ in written if not a]
+        added += [name for _, name, _ in renamed]
+        conflicts += [
+            name for name in added if os.path.isfile(os.path.join(path, name))
+        ]
+
+        if conflicts:
+            names = "\n - ".join(os.fsdecode(name) for name in sorted(conflicts))
+            raise Exception(f"Local changes would be overwritten:\n - {names}")
 
-    def ref_resolve(self, ref):
-        with open(self.repo_file(ref), "r") as fp:
-            data = fp.read()[:-1]
-            # Drop final \n ^^^^^
-        if data.startswith("ref: "):
-            return self.ref_resolve(data[5:])
-        else:
-            return data
+    @staticmethod
+    def tree_update_blocked(path, gone, added):
+        """The names in added that can't be written once the files in gone
+        are: those under a file that isn't in gone, and those where a
+        directory is that holds anything else than files in gone."""
+        blocked = list()
+        for name in added:
+            # The nearest thing above name that exists must be a directory,
+            # or go away.
+            parent = os.path.dirname(name)
+            while parent:
+                dest = os.path.join(path, parent)
+                if os.path.isdir(dest):
+                    break
+                if os.path.lexists(dest):
+                    if parent not in gone:
+                        blocked.append(name)
+                    break
+                parent = os.path.dirname(parent)
+
+            dest = os.path.join(path, name)
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                for root, dirs, files in os.walk(dest):
+                    files += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                    left = [
+                        f
+                        for f in files
+                        if os.path.relpath(os.path.join(root, f), path) not in gone
+                    ]
+                    if left:
+                        blocked.append(name)
+                        break
+        return blocked
+
+    def file_matches(self, path, sha):
+        """Whether the file at path holds blob sha.  Files of the wrong
+        size are told apart without reading them."""
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        if not stat.S_ISREG(st.st_mode) or st.st_size != self.object_info(sha)[1]:
+            return False
+        with open(path, "rb") as fd:
+            return GitObject.hash(fd, b"blob") == sha
 
-    def ref_list(self, path=None):
-        if path is None:
-            path = self.repo_dir("refs")
-        ret = collections.OrderedDict()
+    @staticmethod
+    def update_dest(path, name):
+        """The path to write name to, making room for it."""
+        dest = os.path.join(path, name)
+        parent = os.path.dirname(dest)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        elif os.path.isdir(dest):
+            # Was a directory, emptied by the update.
+            os.rmdir(dest)
+        return dest
 
-        for f in sorted(os.listdir(path)):
-            can = os.path.join(path, f)
-            if os.path.isdir(can):
-                ret[f] = self.ref_list(can)
+    @staticmethod
+    def prune_dirs(path, names):
+        """Remove the directories left empty by deleting names, deepest
+        first, stopping at path."""
+        dirs = set()
+        for name in names:
+            name = os.path.dirname(name)
+            while name and name not in dirs:
+                dirs.add(name)
+                name = os.path.dirname(name)
+        for name in sorted(dirs, key=len, reverse=True):
+            dest = os.path.join(path, name)
+            if os.path.isdir(dest) and not os.listdir(dest):
+                os.rmdir(dest)
+
+    def blob_checkout(self, sha, dest):
+        # Blobs are copied chunk by chunk, never read whole.
+        fmt, _, chunks = self.object_open(sha)
+        if fmt != b"blob":
+            raise Exception(f"Expected a blob for {os.fsdecode(dest)}, got {fmt}")
+        with open(dest, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def tree_files(self, tree, base=b"", want_dir=None):
+        """Yield (path, mode, sha) for every file under tree.  They come
+        sorted by path, which is also the order of the index.  Only the
+        directories for whose path want_dir is true, if given, are read."""
+        for item in tree.items:
+            path = base + item.path
+            if item.mode.startswith(b"4"):
+                if want_dir is None or want_dir(path):
+                    subtree = self.object_read(item.sha)
+                    yield from self.tree_files(subtree, path + b"/", want_dir)
             else:
-                ret[f] = self.ref_resolve(can)
+                yield path, item.mode, item.sha
+
+    def grep(
+        self,
+        pattern,
+        tree,
+        pathspecs=(),
+        jobs=None,
+        ignore_case=False,
+        files_only=False,
+        batch=32,
+    ):
+        """Search the files of tree named by pathspecs, or all of them, for
+        the regular expression pattern, a bytes.  Yield the output, as
+        GitGrep.grep_blobs() makes it, in path order and batch by batch.
+
+        Paths are filtered before any blob is read.  Blobs are inflated
+        and searched in a pool of jobs processes, since re holds the GIL,
+        and each batch is yielded as soon as those before it are done."""
+        import GitGrep
+
+        # Fail early, rather than in every worker.
+        re.compile(pattern)
+
+        want_dir = None
+        if pathspecs:
+
+            def want_dir(path):
+                return GitGrep.pathspec_dir(path, pathspecs)
+
+        def batches():
+            entries = list()
+            for path, mode, sha in self.tree_files(tree, want_dir=want_dir):
+                if mode == b"160000":
+                    continue
+                if pathspecs and not GitGrep.pathspec_match(path, pathspecs):
+                    continue
+                entries.append((path, sha))
+                if len(entries) == batch:
+                    yield entries
+                    entries = list()
+            if entries:
+                yield entries
+
+        args = (self.worktree, pattern, ignore_case, files_only)
+        jobs = jobs or os.cpu_count() or 1
+        if jobs == 1:
+            for entries in batches():
+                yield GitGrep.grep_blobs(*args, entries)
+            return
 
-        return ret
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            futures = collections.deque()
+            for entries in batches():
+                futures.append(pool.submit(GitGrep.grep_blobs, *args, entries))
+                # Keep the queue bounded, and the output flowing.
+                while len(futures) > 4 * jobs:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def index_read(self):
+        from GitIndex import GitIndex
+
+        return GitIndex.read(self.repo_path("index"))
+
+    def index_write(self, index):
+        index.write(self.repo_path("index"))
+
+    def file_sha(self, path, st):
+        """The blob SHA of the worktree file at path, with os.lstat result
+        st, streamed rather than read whole."""
+        if stat.S_ISLNK(st.st_mode):
+            return GitBlob(self, os.readlink(path)).object_write(False)
+        with open(path, "rb") as fd:
+            return GitObject.hash(fd, b"blob")
+
+    def add(self, names, jobs=None):
+        """Stage the files or directories names, paths relative to the
+        worktree, in the index.  Files whose stat data says they haven't
+        changed since they were last staged aren't hashed again, and
+        staged files that no longer exist are removed."""
+        from GitIndex import file_mode
+
+        index = self.index_read()
+        worktree = os.fsencode(self.worktree)
+        filemode = self.conf.getboolean("core", "filemode", fallback=True)
+
+        files = list()
+        for name in names:
+            path = os.path.join(worktree, name) if name else worktree
+            if os.path.isdir(path) and not os.path.islink(path):
+                found = set()
+                for root, dirs, walked in os.walk(path):
+                    dirs[:] = sorted(d for d in dirs if d != b".git")
+                    for f in walked:
+                        found.add(os.path.relpath(os.path.join(root, f), worktree))
+                files.extend(sorted(found))
+            elif os.path.lexists(path):
+                found = {name}
+                files.append(name)
+            else:
+                found = set()
+
+            # Whatever was staged under name and is gone gets unstaged.
+            lo, hi = index.prefix(name) if name else (0, len(index))
+            gone = [i for i in range(lo, hi) if index.paths[i] not in found]
+            if not found and not gone:
+                raise Exception(f"Path {os.fsdecode(name)} did not match any files")
+            for i in reversed(gone):
+                index.remove(i, i + 1)
+
+        # Only hash the files that may have changed.
+        stale = list()
+        for name in files:
+            st = os.lstat(os.path.join(worktree, name))
+            i = index.find(name)
+            if i is None or not index.stat_matches(i, st) or index.is_racy(i):
+                stale.append((name, st))
+
+        regular = [
+            os.path.join(worktree, name)
+            for name, st in stale
+            if not stat.S_ISLNK(st.st_mode)
+        ]
+        with self.object_batch():
+            shas = iter(hash_files(regular, b"blob", self, jobs=jobs))
+            for name, st in stale:
+                if stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(os.path.join(worktree, name))
+                    sha = GitBlob(self, target).object_write()
+                else:
+                    sha = next(shas)
+
+                mode = file_mode(st)
+                i = index.find(name)
+                if not filemode and mode != 0o120000:
+                    # Keep the executable bit we had, if any.
+                    mode = index.mode(i) if i is not None else 0o100644
+                index.set(name, sha, mode, st)
+
+        self.index_write(index)
+        return len(stale)
+
+    def status(self, jobs=None):
+        """Compare HEAD, the index and the worktree.  Return the sorted
+        list of (x, y, path) for every path that differs, where x is how
+        the index differs from HEAD, and y how the worktree differs from
+        the index, in the letters of git status --short; untracked files
+        come last, as ("?", "?", path).
+
+        Worktree files are only hashed when their stat data doesn't match
+        the index's.  Those found unchanged anyway get their stat data
+        refreshed, and the index is written back if it isn't locked."""
+        from GitIndex import file_mode
+
+        index = self.index_read()
+        changes = collections.defaultdict(lambda: [" ", " "])
+
+        head = self.ref_resolve("HEAD")
+        if head:
+            tree = self.object_read(self.object_find(head, b"tree"))
+            staged = self.tree_files(tree)
+        else:
+            staged = iter(())
+
+        # HEAD against the index: both are sorted by path.
+        entries = (
+            (index.paths[i], index.mode(i), index.sha(i), index.stages[i])
+            for i in range(len(index))
+        )
+        old = next(staged, None)
+        new = next(entries, None)
+        while old or new:
+            if new and new[3]:
+                changes[new[0]] = ["U", "U"]
+                if old and old[0] == new[0]:
+                    old = next(staged, None)
+                while new and new[3]:
+                    new = next(entries, None)
+                continue
+            if new is None or (old and old[0] < new[0]):
+                changes[old[0]][0] = "D"
+                old = next(staged, None)
+            elif old is None or new[0] < old[0]:
+                changes[new[0]][0] = "A"
+                new = next(entries, None)
+            else:
+                if old[2] != new[2] or int(old[1], 8) != new[1]:
+                    changes[new[0]][0] = "M"
+                old = next(staged, None)
+                new = next(entries, None)
+
+        # The index against the worktree.
+        worktree = os.fsencode(self.worktree)
+        filemode = self.conf.getboolean("core", "filemode", fallback=True)
+
+        def check(positions):
+            found = list()
+            for i in positions:
+                mode = index.mode(i)
+                if index.stages[i] or mode == 0o160000:
+                    continue
+                path = os.path.join(worktree, index.paths[i])
+                try:
+                    st = os.lstat(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    found.append((i, "D", None))
+                    continue
+                if index.stat_matches(i, st) and not index.is_racy(i):
+                    continue
+                if filemode and file_mode(st) != mode:
+                    found.append((i, "M", None))
+                elif file_mode(st) & 0o170000 != mode & 0o170000:
+                    found.append((i, "T", None))
+                elif st.st_size & 0xFFFFFFFF != index.stat(i)[9]:
+                    found.append((i, "M", None))
+                elif self.file_sha(path, st) != index.sha(i):
+                    found.append((i, "M", None))
+                else:
+                    found.append((i, None, st))
+            return found
+
+        jobs = jobs or 1
+        if jobs > 1 and len(index) > 1000:
+            chunk = -(-len(index) // jobs)
+            ranges = [
+                range(i, min(i + chunk, len(index)))
+                for i in range(0, len(index), chunk)
+            ]
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                results = list(itertools.chain.from_iterable(pool.map(check, ranges)))
+        else:
+            results = check(range(len(index)))
 
-    def show_ref(self, refs, with_hash=True, prefix=""):
-        for k, v in refs.items():
-            if type(v) == str:
-                print(
-                    "{0}{1}{2}".format(
-                        v + " " if with_hash else "", prefix + "/" if prefix else "", k,
-                    )
-                )
+        refreshed = False
+        for i, status, st in results:
+            if status:
+                changes[index.paths[i]][1] = status
             else:
-                self.show_ref(
-                    v,
-                    with_hash=with_hash,
-                    prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k),
-                )
+                index.refresh(i, st)
+                refreshed = True
+        if refreshed:
+            try:
+                self.index_write(index)
+            except Exception:
+                # Someone else holds the lock: the refresh can wait.
+                pass
+
+        result = sorted(
+            ((x, y, path) for path, (x, y) in changes.items()), key=lambda c: c[2]
+        )
+        return result + [("?", "?", path) for path in self.untracked(index)]
+
+    def untracked(self, index):
+        """Yield the paths of the worktree files the index doesn't know
+        about, sorted.  Like git, a directory holding nothing but
+        untracked files is listed as a whole, as "dir/"."""
+        worktree = os.fsencode(self.worktree)
+        tracked = set(index.paths)
+        stack = [b""]
+        found = list()
+        while stack:
+            base = stack.pop()
+            with os.scandir(os.path.join(worktree, base)) as it:
+                for entry in it:
+                    name = base + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name == b".git":
+                            continue
+                        lo, hi = index.prefix(name)
+                        if lo < hi:
+                            stack.append(name + b"/")
+                        elif self.has_files(entry.path):
+                            found.append(name + b"/")
+                    elif name not in tracked:
+                        found.append(name)
+        return sorted(found)
+
+    @staticmethod
+    def has_files(path):
+        for _, _, files in os.walk(path):
+            if files:
+                return True
+        return False
+
+    def ref_read(self, ref):
+        """Return the contents of the loose ref file ref, without the final
+        newline, or None if there is no such file.  Contents are cached,
+        and only read again when the file's mtime or size changes."""
+        path = self.repo_path(ref)
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            self._ref_cache.pop(ref, None)
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            return None
+
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._ref_cache.get(ref)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        with open(path, "r") as fp:
+            data = fp.read()[:-1]
+            # Drop final \n ^^^^^
+        self._ref_cache[ref] = (key, data)
+        if PerfTrace.enabled:
+            PerfTrace.count("ref file read", st.st_size)
+        return data
+
+    def packed_refs(self):
+        """Return (refs, peeled), two dicts mapping ref names from
+        packed-refs to their SHA and, for annotated tags, to the SHA of
+        the object they ultimately point to.  Cached like ref_read."""
+        path = self.repo_path("packed-refs")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return {}, {}
+
+        key = (st.st_mtime_ns, st.st_size)
+        if self._packed_refs and self._packed_refs[0] == key:
+            return self._packed_refs[1]
+
+        refs = dict()
+        peeled = dict()
+        last = None
+        with open(path, "r") as fp:
+            for line in fp:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("^"):
+                    # Peeled value of the previous ref.
+                    peeled[last] = line[1:]
+                    continue
+                sha, last = line.split(" ", 1)
+                refs[last] = sha
+
+        self._packed_refs = (key, (refs, peeled))
+        if PerfTrace.enabled:
+            PerfTrace.count("packed-refs file read", st.st_size)
+        return refs, peeled
+
+    def ref_resolve(self, ref):
+        """Follow ref, which may be symbolic, down to a SHA.  Return None
+        if it doesn't exist."""
+        for _ in range(10):
+            data = self.ref_read(ref)
+            if data is None:
+                data = self.packed_refs()[0].get(ref)
+                if data is None:
+                    return None
+
+            if not data.startswith("ref: "):
+                return data
+            ref = data[5:]
+
+        raise Exception(f"Too many levels of symbolic references at {ref}")
+
+    def ref_peel(self, ref):
+        """The SHA of the object ref ultimately points to, following tag
+        objects.  Uses the peeled lines of packed-refs when possible."""
+        peeled = self.packed_refs()[1].get(ref)
+        if peeled and self.ref_read(ref) is None:
+            return peeled
+
+        sha = self.ref_resolve(ref)
+        while sha:
+            obj = self.object_read(sha)
+            if obj.fmt != b"tag":
+                break
+            sha = obj.kvlm[b"object"][0].decode("ascii")
+        return sha
+
+    def ref_iter(self, prefix="refs/"):
+        """Yield (name, sha) for every ref whose name starts with prefix,
+        sorted by name, in a single merged pass over loose and packed
+        refs.  Loose refs take precedence over packed ones."""
+        loose = list()
+        top = self.repo_path(prefix.rstrip("/")) if prefix.endswith("/") else None
+        base = self.repo_path("refs")
+        for root, dirs, files in os.walk(top or base):
+            rel = os.path.relpath(root, self.gitdir).replace(os.sep, "/")
+            for f in files:
+                name = rel + "/" + f
+                if name.startswith(prefix):
+                    loose.append(name)
+        loose.sort()
+
+        packed = sorted(n for n in self.packed_refs()[0] if n.startswith(prefix))
+
+        last = None
+        for name, _ in heapq.merge(((n, 0) for n in loose), ((n, 1) for n in packed)):
+            if name == last:
+                continue
+            last = name
+            sha = self.ref_resolve(name)
+            if sha:
+                yield name, sha
+
+    def ref_list(self):
+        """Every ref, as a tree of nested dicts keyed by path component."""
+        ret = collections.OrderedDict()
+        for name, sha in self.ref_iter():
+            node = ret
+            parts = name.split("/")[1:]
+            for part in parts[:-1]:
+                node = node.setdefault(part, collections.OrderedDict())
+            node[parts[-1]] = sha
+        return ret
+
+    def ref_roots(self):
+        """The SHAs of HEAD and every ref, as starting points for walks."""
+        roots = [sha for _, sha in self.ref_iter()]
+        head = self.ref_resolve("HEAD")
+        # HEAD may point to a branch with no commits yet.
+        if head:
+            roots.insert(0, head)
+        return roots
+
+    def show_ref(self, prefix="refs/", with_hash=True, dereference=False):
+        for name, sha in self.ref_iter(prefix):
+            if not with_hash:
+                print(name[len(prefix) :])
+                continue
+
+            print(f"{sha} {name}")
+            if dereference:
+                peeled = self.ref_peel(name)
+                if peeled != sha:
+                    print(f"{peeled} {name}^{{}}")
+
+    def pack_refs(self, all=False, prune=True):
+        """Move refs into packed-refs: tags, and everything else already
+        packed, or all refs if all.  Symbolic refs stay loose.  If prune,
+        the loose files of the packed refs are deleted."""
+        old, _ = self.packed_refs()
+
+        packed = list()
+        for name, _ in self.ref_iter():
+            data = self.ref_read(name)
+            if data is None:
+                data = old[name]
+            if data.startswith("ref: "):
+                continue
+            if all or name.startswith("refs/tags/") or name in old:
+                packed.append((name, data))
+
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_packed_refs_", dir=self.gitdir)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                fp.write("# pack-refs with: peeled fully-peeled sorted \n")
+                for name, sha in packed:
+                    fp.write(f"{sha} {name}\n")
+                    peeled = self.ref_peel(name)
+                    if peeled != sha:
+                        fp.write(f"^{peeled}\n")
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.repo_path("packed-refs"))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if prune:
+            for name, sha in packed:
+                if self.ref_read(name) == sha:
+                    os.remove(self.repo_path(name))
+                    self._ref_cache.pop(name, None)
+                    self.ref_prune_dirs(name)
+
+        return len(packed)
+
+    def ref_prune_dirs(self, name):
+        """Remove the directories of ref name that are now empty, up to
+        but not including refs/heads, refs/tags and the like."""
+        parts = name.split("/")[:-1]
+        while len(parts) > 2:
+            path = self.repo_path(*parts)
+            if os.listdir(path):
+                return
+            os.rmdir(path)
+            parts.pop()
 
     def tag_create(self, name, reference, create_tag_object):
         # get the GitObject from the object reference
@@ -249,14 +2004,14 @@ class GitRepository:
             # create tag object (commit)
             tag = GitTag(self)
             tag.kvlm = collections.OrderedDict()
-            tag.kvlm[b"object"] = sha.encode()
-            tag.kvlm[b"type"] = b"commit"
-            tag.kvlm[b"tag"] = name.encode()
+            tag.kvlm[b"object"] = [sha.encode()]
+            tag.kvlm[b"type"] = [b"commit"]
+            tag.kvlm[b"tag"] = [name.encode()]
             # TODO: add real messages and tagger
-            tag.kvlm[b"tagger"] = b"The soul eater <grim@reaper.net>"
-            tag.kvlm[
-                b""
-            ] = b"This is the commit message that should have come from the user\n"
+            tag.kvlm[b"tagger"] = [b"The soul eater <grim@reaper.net>"]
+            tag.kvlm[b""] = [
+                b"This is the commit message that should have come from the user\n"
+            ]
             tag_sha = tag.object_write()
             # create reference
             self.ref_create("tags/" + name, tag_sha)
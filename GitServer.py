@@ -0,0 +1,143 @@
+import os
+import socket
+import asyncio
+import concurrent.futures
+
+
+# The protocol is line based.  Each request is a single line,
+#
+#   object <name>     ->  ok <sha> <type> <size>\n<contents>
+#   ref <refname>     ->  ok <sha>\n
+#   rev-parse <name>  ->  ok <sha>\n
+#
+# and any failure is answered with "error <message>\n".
+
+
+class GitServer:
+    """Serve objects and refs of one repository over a Unix socket.
+
+    Keeping a single GitRepository around means its object, ref and pack
+    caches stay warm across requests.  Everything that may touch zlib or
+    the disk runs on a thread pool, so that a client reading a large blob
+    doesn't hold up the others."""
+
+    def __init__(self, repo, workers=None):
+        self.repo = repo
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.client, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown()
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, fn, *args)
+
+    async def client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, arg = line.decode("utf-8", "replace").strip().partition(" ")
+
+                try:
+                    if command == "object":
+                        await self.send_object(writer, arg)
+                    elif command == "ref":
+                        sha = await self.run(self.repo.ref_resolve, arg)
+                        if not sha:
+                            raise Exception(f"No such ref {arg}")
+                        writer.write(f"ok {sha}\n".encode())
+                    elif command == "rev-parse":
+                        sha = await self.run(self.repo.object_find, arg)
+                        writer.write(f"ok {sha}\n".encode())
+                    else:
+                        raise Exception(f"Unknown command {command}")
+                except ConnectionError:
+                    # Either the client is gone, or send_object gave up
+                    # partway through a body: hang up either way.
+                    raise
+                except Exception as e:
+                    message = str(e).replace("\n", " ")
+                    writer.write(f"error {message}\n".encode())
+
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def send_object(self, writer, name):
+        sha = await self.run(self.repo.object_find, name)
+        if not await self.run(self.repo.object_exists, sha):
+            raise Exception(f"No such object {name}")
+
+        fmt, size, chunks = await self.run(self.repo.object_open, sha)
+        writer.write(f"ok {sha} {fmt.decode()} {size}\n".encode())
+
+        # Once the header is out we're committed: pull the contents one
+        # chunk at a time from the pool, letting the client drain them.
+        # An error from here on can't be reported in band, so we hang up.
+        try:
+            while True:
+                chunk = await self.run(next, chunks, None)
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+        except Exception as e:
+            raise ConnectionError(f"Failed sending {sha}: {e}")
+
+
+class GitClient:
+    """A blocking client for GitServer."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, command, arg):
+        self.f.write(f"{command} {arg}\n".encode())
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            raise Exception("Connection closed by server")
+
+        status, _, rest = line.decode().rstrip("\n").partition(" ")
+        if status != "ok":
+            raise Exception(rest)
+        return rest
+
+    def object(self, name):
+        """Return (sha, fmt, data) for object name."""
+        sha, fmt, size = self.request("object", name).split(" ")
+        data = self.f.read(int(size))
+        if len(data) != int(size):
+            raise Exception(f"Connection closed by server while reading {sha}")
+        return sha, fmt.encode(), data
+
+    def ref(self, name):
+        return self.request("ref", name)
+
+    def rev_parse(self, name):
+        return self.request("rev-parse", name)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
@@ -1,31 +1,152 @@
 import os
+import sys
+import contextlib
+import itertools
+import re
+import time
+import datetime
 
+from GitObject import GitObject, hash_files
 from GitRepository import GitRepository
 
 
+def parse_date(value):
+    """Parse a --since style date: a Unix timestamp, or an ISO 8601 date
+    with an optional time, taken as UTC when no timezone is given."""
+    if value.isdigit():
+        return int(value)
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+
+def walk_files(paths):
+    """Expand directories in paths to the files under them, sorted, and
+    leaving out .git directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != ".git")
+            for f in sorted(files):
+                yield os.path.join(root, f)
+
+
+def count_files(paths, stats):
+    for path in paths:
+        stats["files"] += 1
+        stats["bytes"] += os.path.getsize(path)
+        yield path
+
+
 class Handlers:
     def init(args):
         GitRepository.create(args.path)
 
     def cat_file(args):
-        GitRepository.find().cat_file(args.object, fmt=args.type.encode())
+        repo = GitRepository.find()
+
+        if args.batch or args.batch_check:
+            repo.cat_file_batch(
+                sys.stdin.buffer,
+                sys.stdout.buffer,
+                contents=args.batch,
+                flush=args.flush,
+            )
+            return
+
+        if not (args.type and args.object):
+            raise Exception("cat-file needs a type and an object, or --batch")
+        repo.cat_file(args.object, fmt=args.type.encode())
 
     def hash_object(args):
         if args.write:
-            repo = GitRepository(".")
+            repo = GitRepository.find()
         else:
             repo = None
 
-        with open(args.path, "rb") as fd:
-            sha = object_hash(fd, args.type.encode(), repo)
-            print(sha)
+        paths = list(args.path)
+        if not (paths or args.stdin_paths):
+            raise Exception("hash-object needs a path, or --stdin-paths")
+
+        if len(paths) == 1 and not (args.stdin_paths or args.recursive):
+            with open(paths[0], "rb") as fd:
+                sha = GitObject.hash(fd, args.type.encode(), repo)
+                print(sha)
+            return
+
+        if args.stdin_paths:
+            paths = itertools.chain(
+                paths, (line.rstrip("\n") for line in sys.stdin if line.strip())
+            )
+        if args.recursive:
+            paths = walk_files(paths)
+
+        stats = {"files": 0, "bytes": 0}
+        if args.stats:
+            paths = count_files(paths, stats)
+
+        start = time.perf_counter()
+        with repo.object_batch() if repo else contextlib.nullcontext():
+            for sha in hash_files(paths, args.type.encode(), repo, jobs=args.jobs):
+                print(sha)
+
+        if args.stats:
+            elapsed = time.perf_counter() - start
+            print(
+                f"{stats['files']} files, {stats['bytes'] / 1e6:.1f} MB"
+                f" in {elapsed:.2f}s: {stats['files'] / elapsed:.0f} files/s,"
+                f" {stats['bytes'] / 1e6 / elapsed:.1f} MB/s",
+                file=sys.stderr,
+            )
+
+    def grep(args):
+        repo = GitRepository.find()
+
+        if "--" in args.rest:
+            i = args.rest.index("--")
+            revs, pathspecs = args.rest[:i], args.rest[i + 1 :]
+        else:
+            # argparse drops a "--" right after the pattern, so tell the
+            # revision from the paths by whether it names an object.
+            n = 1 if args.rest and repo.object_resolve(args.rest[0]) else 0
+            revs, pathspecs = args.rest[:n], args.rest[n:]
+        if len(revs) > 1:
+            raise Exception("grep searches a single revision")
+        rev = revs[0] if revs else "HEAD"
+        sha = repo.object_find(rev, b"tree")
+        if not sha:
+            raise Exception(f"{rev} is not a tree-ish")
+
+        pattern = os.fsencode(args.pattern)
+        if args.fixed:
+            pattern = re.escape(pattern)
+        out = sys.stdout.buffer
+        for chunk in repo.grep(
+            pattern,
+            repo.object_read(sha),
+            [os.fsencode(p) for p in pathspecs],
+            jobs=args.jobs,
+            ignore_case=args.ignore_case,
+            files_only=args.files_only,
+        ):
+            if chunk:
+                out.write(chunk)
+                out.flush()
 
     def log(args):
         repo = GitRepository.find()
 
-        print("digraph wyaglog{")
-        repo.log_graphviz(repo.object_find(args.commit))
-        print("}")
+        starts = [repo.object_find(name, fmt=b"commit") for name in args.commit]
+        since = parse_date(args.since) if args.since else None
+        commits = repo.rev_walk(starts, order=args.order, since=since)
+        if args.max_count is not None:
+            commits = itertools.islice(commits, args.max_count)
+
+        fmt = "oneline" if args.oneline else args.format
+        getattr(repo, "log_" + fmt)(commits)
 
     def checkout(args):
         repo = GitRepository.find()
@@ -36,6 +157,16 @@ class Handlers:
         if obj.fmt == b"commit":
             obj = repo.object_read(obj.kvlm[b"tree"][0].decode("ascii"))
 
+        if args.old:
+            # Update a previous checkout of args.old in place.
+            if not os.path.isdir(args.path):
+                raise Exception(f"Not a directory {args.path}!")
+            old = repo.object_read(repo.object_find(args.old, b"tree"))
+            repo.tree_update(
+                old, obj, os.path.realpath(args.path).encode(), check=args.check
+            )
+            return
+
         # Verify that path is an empty directory
         if os.path.exists(args.path):
             if not os.path.isdir(args.path):
@@ -45,11 +176,11 @@ class Handlers:
         else:
             os.makedirs(args.path)
 
-        repo.tree_checkout(obj, os.path.realpath(args.path).encode())
+        repo.tree_checkout(obj, os.path.realpath(args.path).encode(), jobs=args.jobs)
 
     def show_ref(args):
         repo = GitRepository.find()
-        repo.show_ref(repo.ref_list(), prefix="refs")
+        repo.show_ref(dereference=args.dereference)
 
     def tag(args):
         repo = GitRepository.find()
@@ -57,13 +188,179 @@ class Handlers:
         if args.name:
             repo.tag_create(args.name, args.object, args.create_tag_object)
         else:
-            refs = repo.ref_list()
-            repo.show_ref(refs["tags"], with_hash=False)
+            repo.show_ref("refs/tags/", with_hash=False)
+
+    def merge_base(args):
+        repo = GitRepository.find()
+
+        commits = list()
+        for name in args.commit:
+            sha = repo.object_find(name, b"commit")
+            if not sha:
+                raise Exception(f"{name} is not a commit")
+            commits.append(sha)
+
+        if args.is_ancestor:
+            if len(commits) != 2:
+                raise Exception("--is-ancestor takes exactly two commits")
+            sys.exit(0 if repo.is_ancestor(commits[0], commits[1]) else 1)
+        if len(commits) < 2:
+            raise Exception("merge-base needs at least two commits")
+
+        bases = repo.merge_base(commits[0], commits[1:])
+        if not bases:
+            sys.exit(1)
+        for sha in bases if args.all else bases[:1]:
+            print(sha)
+
+    def rev_list(args):
+        repo = GitRepository.find()
+
+        # Tags are objects of their own, but only listed with --objects.
+        fmt = None if args.objects else b"commit"
+        starts, excludes = list(), list()
+        for name in args.commit:
+            exclude = name.startswith("^")
+            sha = repo.object_find(name[1:] if exclude else name, fmt)
+            if not sha:
+                raise Exception(f"Bad revision {name}")
+            (excludes if exclude else starts).append(sha)
+        if args.all:
+            roots = repo.ref_roots()
+            if fmt:
+                roots = [repo.object_find(sha, fmt) for sha in roots]
+            starts += [sha for sha in roots if sha]
+
+        if args.count:
+            print(repo.rev_list_count(starts, excludes, args.objects, args.use_bitmap))
+            return
+        out = sys.stdout.buffer
+        for sha, fmt, path in repo.rev_list(
+            starts, excludes, args.objects, args.use_bitmap
+        ):
+            if fmt == b"commit":
+                out.write(sha.encode() + b"\n")
+            else:
+                out.write(sha.encode() + b" " + path + b"\n")
 
     def rev_parse(args):
-        if args.type:
-            fmt = args.type.encode()
+        fmt = args.type.encode() if args.type else None
+
+        repo = GitRepository.find()
+
+        sha = repo.object_find(args.name, fmt, follow=True)
+        if sha and args.short:
+            sha = repo.object_abbrev(sha, args.abbrev)
+        print(sha)
+
+    def diff_tree(args):
+        repo = GitRepository.find()
+
+        if args.new:
+            old = repo.object_read(repo.object_find(args.old, b"tree"))
+            new = repo.object_read(repo.object_find(args.new, b"tree"))
+            pairs = [(None, old, new)]
+        else:
+            # A single commit is compared to its parent.  Like git, a merge
+            # shows nothing unless -m asks for a diff against each parent.
+            sha = repo.object_find(args.old, b"commit")
+            if not sha:
+                raise Exception(f"{args.old} is not a commit")
+            parents = repo.object_read(sha).kvlm.get(b"parent") or []
+            if len(parents) > 1 and not args.merges:
+                return
+            new = repo.object_read(repo.object_find(sha, b"tree"))
+            pairs = [
+                (sha, repo.object_read(repo.object_find(p.decode(), b"tree")), new)
+                for p in parents
+            ]
+
+        out = sys.stdout.buffer
+        for header, old, new in pairs:
+            if header:
+                out.write(header.encode() + b"\n")
+            for status, path, a, b in repo.diff_tree(
+                old, new, recursive=args.recursive
+            ):
+                if args.name_only:
+                    out.write(path + b"\n")
+                elif args.name_status:
+                    out.write(status.encode() + b"\t" + path + b"\n")
+                else:
+                    out.write(
+                        b":%s %s %s %s %s\t%s\n"
+                        % (
+                            a.mode.rjust(6, b"0") if a else b"000000",
+                            b.mode.rjust(6, b"0") if b else b"000000",
+                            a.sha.encode() if a else b"0" * 40,
+                            b.sha.encode() if b else b"0" * 40,
+                            status.encode(),
+                            path,
+                        )
+                    )
+
+    def add(args):
+        repo = GitRepository.find()
+
+        names = list()
+        for path in args.path:
+            name = os.path.relpath(os.path.abspath(path), repo.worktree)
+            if name == os.pardir or name.startswith(os.pardir + os.sep):
+                raise Exception(f"{path} is outside the repository")
+            names.append(os.fsencode("" if name == os.curdir else name))
+        repo.add(names, jobs=args.jobs)
 
+    def status(args):
         repo = GitRepository.find()
 
-        print(repo.object_find(args.name, args.type, follow=True))
+        out = sys.stdout.buffer
+        for x, y, path in repo.status(jobs=args.jobs):
+            out.write(f"{x}{y} ".encode() + path + b"\n")
+
+    def repack(args):
+        repo = GitRepository.find()
+        idx = repo.repack(
+            window=args.window, depth=args.depth, prune=args.delete, bitmap=args.bitmap
+        )
+        if idx:
+            print(os.path.basename(idx)[5:-4])
+
+    def gc(args):
+        repo = GitRepository.find()
+        repo.pack_refs()
+        repo.repack()
+        repo.commit_graph_write()
+
+    def fsck(args):
+        repo = GitRepository.find()
+        corrupt, missing, dangling = repo.fsck(jobs=args.jobs)
+
+        for sha, error in corrupt:
+            print(f"error: {sha}: {error}" if sha else f"error: {error}")
+        for fmt, sha in missing:
+            print(f"missing {fmt.decode()} {sha}")
+        if args.dangling:
+            for fmt, sha in dangling:
+                print(f"dangling {fmt.decode()} {sha}")
+        if corrupt or missing:
+            sys.exit(1)
+
+    def pack_refs(args):
+        repo = GitRepository.find()
+        repo.pack_refs(all=args.all, prune=args.prune)
+
+    def commit_graph(args):
+        repo = GitRepository.find()
+        if args.action == "write":
+            repo.commit_graph_write()
+
+    def serve(args):
+        import asyncio
+        from GitServer import GitServer
+
+        repo = GitRepository.find()
+        server = GitServer(repo, workers=args.workers)
+        try:
+            asyncio.run(server.serve(args.socket))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,67 @@
+import collections
+import threading
+
+
+class ObjectCache:
+    """A least-recently-used cache of parsed objects, bounded by the
+    total size of their decompressed contents.
+
+    Only objects whose type is in `fmts` are kept, so that a few large
+    blobs can't push out the commits and trees that history walks and
+    checkouts keep coming back to.
+
+    Cached objects are handed to every caller that reads them, which is
+    why object_read freezes them.  Hits, misses and evictions are counted,
+    and reported by PerfTrace, to tune core.wyagCacheSize and
+    core.wyagCacheTypes against."""
+
+    def __init__(self, max_bytes, fmts=None):
+        self.max_bytes = max_bytes
+        self.fmts = fmts
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The object server reads objects from several threads.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, sha):
+        with self.lock:
+            entry = self.entries.get(sha)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(sha)
+            return entry[0]
+
+    def put(self, sha, obj, size):
+        if self.fmts is not None and obj.fmt not in self.fmts:
+            return
+
+        with self.lock:
+            if size > self.max_bytes or sha in self.entries:
+                return
+
+            self.entries[sha] = (obj, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "objects": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+
+def _prefix_lowest(prefix):
+    """The lowest binary SHA a hex prefix of any length can match."""
+    return bytes.fromhex(prefix.ljust(40, "0"))
+
+
+def _common_hex_prefix(a, b):
+    """Length of the common prefix of two binary SHAs, in hex digits."""
+    for i in range(20):
+        if a[i] != b[i]:
+            return 2 * i + (1 if a[i] >> 4 == b[i] >> 4 else 0)
+    return 40
+
+
+class SortedSHAs:
+    """A view over any sorted table of binary SHAs: get(i) returns the
+    i-th SHA, and lower(binsha) the position of the first one that is not
+    lower than binsha."""
+
+    def __init__(self, count, get, lower):
+        self.count = count
+        self.get = get
+        self.lower = lower
+
+    def prefix(self, prefix):
+        """Yield the SHAs starting with the hex string prefix."""
+        i = self.lower(_prefix_lowest(prefix))
+        while i < self.count:
+            binsha = self.get(i)
+            if not binsha.hex().startswith(prefix):
+                return
+            yield binsha
+            i += 1
+
+    def neighbours(self, binsha):
+        """Yield the SHAs immediately before and after binsha."""
+        i = self.lower(binsha)
+        if i > 0:
+            yield self.get(i - 1)
+        if i < self.count and self.get(i) == binsha:
+            i += 1
+        if i < self.count:
+            yield self.get(i)
+
+
+class ObjectNames:
+    """Every object name in a repository, sorted, for prefix lookups.
+
+    Packs already carry a sorted table of their objects in their .idx,
+    which we bisect in place.  Loose objects are listed once, on first
+    use, into a sorted list that object writes then keep up to date.
+
+    Objects may be written from several threads at once, as by
+    hash_files(), so the list is only touched under a lock."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.loose = None
+        self.lock = threading.RLock()
+
+    def loose_names(self):
+        with self.lock:
+            if self.loose is None:
+                self.loose = sorted(bytes.fromhex(s) for s in self.repo.loose_objects())
+            return self.loose
+
+    def add(self, sha):
+        """Record that the loose object sha was just written."""
+        binsha = bytes.fromhex(sha)
+        with self.lock:
+            if self.loose is None:
+                return
+            i = bisect.bisect_left(self.loose, binsha)
+            if i == len(self.loose) or self.loose[i] != binsha:
+                self.loose.insert(i, binsha)
+
+    def reset(self):
+        """Forget loose objects, eg after they got packed."""
+        with self.lock:
+            self.loose = None
+
+    def tables(self):
+        loose = self.loose_names()
+        yield SortedSHAs(
+            len(loose), loose.__getitem__, lambda k: bisect.bisect_left(loose, k)
+        )
+        for pack in self.repo.packs():
+            index = pack.index
+            yield SortedSHAs(len(index), index.sha, index.bisect)
+
+    def find(self, prefix):
+        """Return the sorted hex SHAs of every object starting with the
+        hex string prefix."""
+        prefix = prefix.lower()
+        found = set()
+        with self.lock:
+            for table in self.tables():
+                found.update(table.prefix(prefix))
+        return sorted(binsha.hex() for binsha in found)
+
+    def abbrev(self, sha, min_length=7):
+        """The shortest prefix of sha, at least min_length long, that
+        names no other object."""
+        binsha = bytes.fromhex(sha)
+        length = min_length
+        with self.lock:
+            for table in self.tables():
+                for other in table.neighbours(binsha):
+                    if other != binsha:
+                        length = max(length, _common_hex_prefix(binsha, other) + 1)
+        return sha[: min(length, 40)]
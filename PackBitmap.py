@@ -0,0 +1,220 @@
+import array
+import hashlib
+import struct
+
+
+# See git's Documentation/technical/bitmap-format.txt
+BITMAP_MAGIC = b"BITM"
+BITMAP_OPT_FULL_DAG = 0x1
+
+# The type bitmaps, in their order in the file.
+BITMAP_TYPES = (b"commit", b"tree", b"blob", b"tag")
+
+# Besides the tips of refs, one commit in this many gets a bitmap.
+SELECT_INTERVAL = 100
+
+# How far back the bitmap a bitmap is stored as the XOR of may be.
+XOR_WINDOW = 10
+
+# An EWAH run length word: bit 0 is the bit repeated, the next 32 bits
+# how many words of it there are, and the top 31 bits how many literal
+# words follow.
+FULL_WORD = (1 << 64) - 1
+RUN_MAX = (1 << 32) - 1
+LITERALS_MAX = (1 << 31) - 1
+
+
+def ewah_decode(data, pos):
+    """Decode the EWAH bitmap at pos in data.  Return it as an int, bit i
+    of which is bit i of the bitmap, and the position after it."""
+    _, count = struct.unpack_from(">II", data, pos)
+    pos += 8
+    words = struct.unpack_from(f">{count}Q", data, pos)
+    pos += 8 * count + 4
+
+    parts = list()
+    i = 0
+    while i < count:
+        rlw = words[i]
+        run = (rlw >> 1) & RUN_MAX
+        if run:
+            parts.append((b"\xff" if rlw & 1 else b"\x00") * (8 * run))
+        literals = rlw >> 33
+        parts.append(struct.pack(f"<{literals}Q", *words[i + 1 : i + 1 + literals]))
+        i += 1 + literals
+    return int.from_bytes(b"".join(parts), "little"), pos
+
+
+def ewah_encode(bits, size):
+    """Encode the first size bits of the int bits as an EWAH bitmap."""
+    n = (size + 63) // 64
+    words = struct.unpack(f"<{n}Q", bits.to_bytes(8 * n, "little"))
+
+    out = list()
+    rlw_pos = 0
+    i = 0
+    while True:
+        rlw_pos = len(out)
+        clean = FULL_WORD if i < n and words[i] == FULL_WORD else 0
+        run = 0
+        while i < n and words[i] == clean and run < RUN_MAX:
+            i += 1
+            run += 1
+        start = i
+        while i < n and 0 != words[i] != FULL_WORD and i - start < LITERALS_MAX:
+            i += 1
+        out.append((clean & 1) | run << 1 | (i - start) << 33)
+        out.extend(words[start:i])
+        if i >= n:
+            break
+
+    return (
+        struct.pack(">II", size, len(out))
+        + struct.pack(f">{len(out)}Q", *out)
+        + struct.pack(">I", rlw_pos)
+    )
+
+
+class PackBitmap:
+    """The reachability bitmaps (.bitmap file) of a pack.  Bit i of a
+    bitmap stands for the i-th object of the pack in offset order, and the
+    bitmap of a commit has the bit of every object reachable from it set.
+
+    Bitmaps are kept as Python ints, so that set operations on them run
+    at C speed; they are only decoded when first asked for."""
+
+    def __init__(self, pack, path=None):
+        self.pack = pack
+        self.index = pack.index
+        self.path = path
+
+        # Pack position -> index position, and back.
+        offsets = self.index.offsets()
+        self.order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        self.positions = array.array("I", bytes(4 * len(offsets)))
+        for pos, i in enumerate(self.order):
+            self.positions[i] = pos
+
+        # Pack position of a commit -> number of its entry, and entry
+        # number -> (XOR offset, position of its EWAH data).
+        self.commits = dict()
+        self.entries = list()
+        self.decoded = dict()
+        self.types = dict()
+        self.type_codes = None
+        if path:
+            self.load(path)
+
+    def __len__(self):
+        return len(self.order)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.data = data
+
+        if len(data) < 32 or data[0:4] != BITMAP_MAGIC:
+            raise Exception(f"Not a bitmap file {path}")
+        version, options, count = struct.unpack(">HHI", data[4:12])
+        if version != 1:
+            raise Exception(f"Unsupported bitmap version {version} in {path}")
+        if not options & BITMAP_OPT_FULL_DAG:
+            raise Exception(f"Bitmap {path} does not cover the whole history")
+        if data[12:32] != self.pack.map[-20:]:
+            raise Exception(f"Bitmap {path} does not match its pack")
+
+        pos = 32
+        for fmt in BITMAP_TYPES:
+            self.types[fmt], pos = ewah_decode(data, pos)
+
+        for n in range(count):
+            idx_pos, xor, _ = struct.unpack_from(">IBB", data, pos)
+            pos += 6
+            self.commits[self.positions[idx_pos]] = n
+            self.entries.append((xor, pos))
+            # Skip the bitmap: header, words, and the RLW position.
+            (words,) = struct.unpack_from(">I", data, pos + 4)
+            pos += 12 + 8 * words
+
+    def position(self, binsha):
+        """The position of binsha in the pack, or None."""
+        i = self.index.bisect(binsha)
+        if i < len(self.order) and self.index.sha(i) == binsha:
+            return self.positions[i]
+        return None
+
+    def sha(self, pos):
+        """The binary SHA of the object at pack position pos."""
+        return self.index.sha(self.order[pos])
+
+    def entry(self, n):
+        # Follow the chain of XORs back to a bitmap we have, or one
+        # stored as is, then decode forward again.
+        chain = list()
+        while n not in self.decoded:
+            chain.append(n)
+            xor = self.entries[n][0]
+            if not xor:
+                break
+            n -= xor
+        bits = self.decoded.get(n, 0)
+        for n in reversed(chain):
+            stored, _ = ewah_decode(self.data, self.entries[n][1])
+            bits = self.decoded[n] = bits ^ stored
+        return bits
+
+    def bitmap(self, pos):
+        """The bitmap of the commit at pack position pos, or None if it
+        doesn't have one."""
+        n = self.commits.get(pos)
+        return None if n is None else self.entry(n)
+
+    def positions_of(self, bits):
+        """Yield the positions of the bits set in bits."""
+        data = bits.to_bytes((len(self) + 7) // 8, "little")
+        for byte, value in enumerate(data):
+            while value:
+                low = value & -value
+                value ^= low
+                yield 8 * byte + low.bit_length() - 1
+
+    def objects(self, bits):
+        """Yield (binsha, fmt) for every object in bits."""
+        if self.type_codes is None:
+            self.type_codes = bytearray(len(self))
+            for code, fmt in enumerate(BITMAP_TYPES, 1):
+                for pos in self.positions_of(self.types.get(fmt, 0)):
+                    self.type_codes[pos] = code
+        for pos in self.positions_of(bits):
+            yield self.sha(pos), BITMAP_TYPES[self.type_codes[pos] - 1]
+
+
+def pack_bitmap_write(f, pack_checksum, size, types, entries):
+    """Write a .bitmap file for a pack of size objects.  types maps each
+    object type to the bitmap of the objects of that type, and entries is
+    a list of (index position, bitmap) for the commits that get one."""
+    sha = hashlib.sha1()
+
+    def write(data):
+        f.write(data)
+        sha.update(data)
+
+    write(BITMAP_MAGIC)
+    write(struct.pack(">HHI", 1, BITMAP_OPT_FULL_DAG, len(entries)))
+    write(pack_checksum)
+    for fmt in BITMAP_TYPES:
+        write(ewah_encode(types.get(fmt, 0), size))
+
+    # Bitmaps of nearby commits differ in few bits: store each as the XOR
+    # with whichever recent bitmap leaves the fewest bits set, if that
+    # beats storing it as is.
+    for n, (idx_pos, bits) in enumerate(entries):
+        best, xor = bits, 0
+        for back in range(1, min(n, XOR_WINDOW) + 1):
+            candidate = bits ^ entries[n - back][1]
+            if candidate.bit_count() < best.bit_count():
+                best, xor = candidate, back
+        write(struct.pack(">IBB", idx_pos, xor, 0))
+        write(ewah_encode(best, size))
+
+    f.write(sha.digest())
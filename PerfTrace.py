@@ -0,0 +1,238 @@
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+
+# Opt-in performance tracing, for finding out where a slow command
+# spends its time.  It is enabled with WYAG_TRACE_PERF, --trace-perf or
+# --trace-perf-out, set to one of
+#
+#   1, table       a summary table on stderr at exit
+#   json:PATH      the same summary, as JSON, in PATH
+#   chrome:PATH    every traced call as a Chrome trace, for about:tracing
+#                  or Perfetto, in PATH
+#
+# When tracing is off, the traced functions are left untouched, and the
+# few counters inside hot paths cost a single test of `enabled`.
+
+enabled = False
+
+# Name -> [calls, seconds] for timed calls, and name -> [count, bytes
+# read, bytes inflated] for data counters.
+timings = dict()
+counters = dict()
+events = None
+
+# Name -> object whose stats() dict goes in the summary, such as the
+# object cache with its hits, misses and evictions.
+sources = dict()
+
+lock = threading.Lock()
+local = threading.local()
+start_time = time.perf_counter()
+
+
+def count(name, read=0, inflated=0):
+    """Count one occurrence of name, with the bytes it read from disk
+    and the bytes it decompressed them to, if any."""
+    with lock:
+        c = counters.get(name)
+        if c is None:
+            c = counters[name] = [0, 0, 0]
+        c[0] += 1
+        c[1] += read
+        c[2] += inflated
+
+
+def watch(name, source):
+    """Report source.stats() under name at exit, if tracing."""
+    if enabled:
+        sources[name] = source
+
+
+def record(name, start, end):
+    with lock:
+        t = timings.get(name)
+        if t is None:
+            t = timings[name] = [0, 0.0]
+        t[0] += 1
+        t[1] += end - start
+        if events is not None:
+            events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - start_time) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+
+def traced(fn, name, suffix=None):
+    """Wrap fn to time its calls under name, or under name:suffix(result)
+    if suffix is given.  Calls nested in a call to the same name, such as
+    recursion, are part of the outer one rather than counted again."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        active = local.__dict__.setdefault("active", set())
+        if name in active:
+            return fn(*args, **kwargs)
+
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            active.discard(name)
+        label = name
+        if suffix:
+            label = f"{name}:{suffix(result)}"
+        record(label, start, end)
+        return result
+
+    return wrapper
+
+
+def traced_stream(fn, name):
+    """Wrap fn, which returns (fmt, size, chunks), to time its calls under
+    name:fmt.  Pulling the chunks is part of the call: the time spent on
+    them is added in, and the call recorded, once they have all been
+    read."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        fmt, size, chunks = fn(*args, **kwargs)
+        busy = time.perf_counter() - start
+
+        def stream():
+            nonlocal busy
+            try:
+                while True:
+                    t = time.perf_counter()
+                    chunk = next(chunks, None)
+                    busy += time.perf_counter() - t
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                record(f"{name}:{fmt.decode()}", start, start + busy)
+
+        return fmt, size, stream()
+
+    return wrapper
+
+
+def instrument():
+    """Replace the functions worth tracing with timed versions."""
+    import GitObject
+    import GitPack
+    import GitRepository
+
+    def object_fmt(obj):
+        return obj.fmt.decode() if obj else "missing"
+
+    targets = [
+        (GitRepository.GitRepository, "object_read", object_fmt),
+        (GitRepository.GitRepository, "object_read_loose", None),
+        (GitRepository.GitRepository, "object_info", None),
+        (GitRepository.GitRepository, "object_resolve", None),
+        (GitRepository.GitRepository, "ref_read", None),
+        (GitRepository.GitRepository, "ref_resolve", None),
+        (GitRepository.GitRepository, "packed_refs", None),
+        (GitRepository.GitRepository, "packs", None),
+        (GitRepository.GitRepository, "bitmap_reach", None),
+        (GitPack.GitPack, "read_at", None),
+        (GitPack.GitPack, "inflate", None),
+        (GitObject, "kvlm_parse", None),
+        (GitObject, "tree_parse", None),
+        (GitObject, "tree_parse_one", None),
+        (GitObject.GitTree, "offsets", None),
+        (GitObject.GitObject, "object_write", None),
+        (os, "listdir", None),
+        (os, "scandir", None),
+    ]
+    for owner, attr, suffix in targets:
+        fn = getattr(owner, attr)
+        name = f"{getattr(owner, '__name__', owner)}.{attr}"
+        setattr(owner, attr, traced(fn, name, suffix))
+
+    # Streamed reads, as of blobs by checkout, cat-file and grep.
+    repo = GitRepository.GitRepository
+    repo.object_open = traced_stream(repo.object_open, "GitRepository.object_open")
+
+
+def enable(spec):
+    """Start tracing, to report as spec says at exit."""
+    global enabled, events
+
+    if enabled:
+        return
+    if spec in ("1", "table", "true", "yes"):
+        out = None
+    elif spec.startswith("json:"):
+        out = spec[5:]
+    elif spec.startswith("chrome:"):
+        out = spec[7:]
+        events = []
+    else:
+        raise Exception(f"Bad performance trace spec {spec}")
+
+    enabled = True
+    instrument()
+    atexit.register(report, out)
+
+
+def summary():
+    return {
+        "elapsed": time.perf_counter() - start_time,
+        "calls": {
+            name: {"calls": calls, "seconds": seconds}
+            for name, (calls, seconds) in sorted(timings.items())
+        },
+        "bytes": {
+            name: {"count": n, "read": read, "inflated": inflated}
+            for name, (n, read, inflated) in sorted(counters.items())
+        },
+        "stats": {name: source.stats() for name, source in sorted(sources.items())},
+    }
+
+
+def report(out=None):
+    if out:
+        import json
+
+        with open(out, "w") as f:
+            if events is not None:
+                json.dump({"traceEvents": events, "otherData": summary()}, f)
+            else:
+                json.dump(summary(), f, indent=2)
+        return
+
+    s = summary()
+    print(f"wyag: {s['elapsed'] * 1000:.1f} ms in total", file=sys.stderr)
+    print(f"{'call':40} {'calls':>9} {'total ms':>11} {'mean us':>9}", file=sys.stderr)
+    for name, t in sorted(s["calls"].items(), key=lambda i: -i[1]["seconds"]):
+        print(
+            f"{name:40} {t['calls']:9} {t['seconds'] * 1000:11.2f}"
+            f" {t['seconds'] / t['calls'] * 1e6:9.1f}",
+            file=sys.stderr,
+        )
+    if s["bytes"]:
+        print(
+            f"{'data':40} {'count':>9} {'read':>11} {'inflated':>11}", file=sys.stderr
+        )
+        for name, c in s["bytes"].items():
+            print(
+                f"{name:40} {c['count']:9} {c['read']:11} {c['inflated']:11}",
+                file=sys.stderr,
+            )
+    for name, stats in s["stats"].items():
+        values = ", ".join(f"{key} {value}" for key, value in stats.items())
+        print(f"{name}: {values}", file=sys.stderr)
@@ -0,0 +1,50 @@
+"""Compare serial and parallel checkout of a synthetic tree.
+
+    python3 benchmarks/checkout.py --width 12 --depth 3 --jobs 8
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, commit_tree, generate, shape_from, stopwatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    add_shape_arguments(parser, commits=1, blob_size=16384)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = generate(os.path.join(tmp, "repo"), **shape_from(args))
+        repo = GitRepository.find(os.path.join(tmp, "repo"))
+        tree = commit_tree(repo, summary["head"])
+        files = summary["files"]
+        dest = os.path.join(tmp, "out").encode()
+
+        timings = dict()
+        for jobs in (1, args.jobs):
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            os.mkdir(dest)
+
+            _, timings[jobs] = stopwatch(
+                lambda: repo.tree_checkout(tree, dest, jobs=jobs)
+            )
+            print(
+                f"jobs={jobs:<3} {timings[jobs]:7.3f}s"
+                f"  {files / timings[jobs]:9.0f} files/s"
+            )
+
+        print(f"speedup: {timings[1] / timings[args.jobs]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
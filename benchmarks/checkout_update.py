@@ -0,0 +1,48 @@
+"""Compare a full checkout with updating a checkout of the previous tree.
+
+    python3 benchmarks/checkout_update.py --width 16 --depth 3 --changes 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, commit_tree, generate, shape_from, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    # Two commits: the second changes --changes files of the first.
+    add_shape_arguments(parser, commits=2, changes=10, width=12, blob_size=1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = generate(os.path.join(tmp, "repo"), **shape_from(args))
+        repo = GitRepository.find(os.path.join(tmp, "repo"))
+        head = summary["head"]
+        parent = repo.object_read(head).kvlm[b"parent"][0].decode("ascii")
+        old, new = commit_tree(repo, parent), commit_tree(repo, head)
+
+        full = os.path.join(tmp, "full").encode()
+        os.mkdir(full)
+        timed("full checkout", lambda: repo.tree_checkout(new, full))
+
+        dest = os.path.join(tmp, "update").encode()
+        os.mkdir(dest)
+        repo.tree_checkout(old, dest)
+        for check in (False, True):
+            timed(
+                f"update{' --check' if check else ''}",
+                lambda: repo.tree_update(old, new, dest, check=check),
+            )
+            # Go back, for the next round.
+            repo.tree_update(new, old, dest)
+
+
+if __name__ == "__main__":
+    main()
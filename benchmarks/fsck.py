@@ -0,0 +1,50 @@
+"""Time fsck with more and more worker processes, on loose and packed objects.
+
+    python3 benchmarks/fsck.py --commits 1000 --max-jobs 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, generate, shape_from, stopwatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count() or 1)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    jobs = [1]
+    while jobs[-1] * 2 <= args.max_jobs:
+        jobs.append(jobs[-1] * 2)
+    if jobs[-1] != args.max_jobs:
+        jobs.append(args.max_jobs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = generate(tmp, **shape_from(args))
+        repo = GitRepository.find(tmp)
+        print(f"{summary['blobs']} blobs, {summary['commits']} commits")
+
+        for layout in ("loose", "packed"):
+            if layout == "packed":
+                repo.repack(window=0)
+            base = None
+            for n in jobs:
+                (corrupt, missing, _), elapsed = stopwatch(lambda: repo.fsck(jobs=n))
+                if corrupt or missing:
+                    raise Exception(f"fsck found problems: {corrupt + missing}")
+                base = base or elapsed
+                print(
+                    f"{layout:6} -j {n:<3} {elapsed:8.3f}s  speedup {base / elapsed:5.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compare grep over a revision with checking it out and searching the files.
+
+    python3 benchmarks/grep.py --commits 200 --width 10 --max-jobs 8
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, commit_tree, generate, shape_from, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pattern", default="wyag99[0-9]\\b")
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count() or 1)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = generate(os.path.join(tmp, "repo"), **shape_from(args))
+        repo = GitRepository.find(os.path.join(tmp, "repo"))
+        tree = commit_tree(repo, summary["head"])
+        print(f"{summary['files']} files, {summary['blob_bytes']} bytes of blobs")
+        pattern = args.pattern.encode()
+
+        def checkout_and_search():
+            dest = os.path.join(tmp, "checkout")
+            os.mkdir(dest)
+            repo.tree_checkout(tree, dest.encode())
+            regex = re.compile(pattern, re.MULTILINE)
+            count = 0
+            for root, _, files in os.walk(dest):
+                for name in files:
+                    with open(os.path.join(root, name), "rb") as f:
+                        count += sum(1 for line in f if regex.search(line))
+            shutil.rmtree(dest)
+            return count
+
+        def grep(jobs, pathspecs=()):
+            output = b"".join(repo.grep(pattern, tree, pathspecs, jobs=jobs))
+            return output.count(b"\n")
+
+        def lines(count):
+            return f"{count} lines"
+
+        timed("checkout, then search", checkout_and_search, describe=lines)
+        jobs = 1
+        while jobs <= args.max_jobs:
+            timed(f"grep -j {jobs}", lambda: grep(jobs), describe=lines)
+            jobs *= 2
+        timed("grep -j 1 -- dir0", lambda: grep(1, [b"dir0"]), describe=lines)
+        if shutil.which("git"):
+            timed(
+                "git grep",
+                lambda: subprocess.run(
+                    ["git", "grep", "-E", args.pattern, summary["head"]],
+                    cwd=repo.worktree,
+                    capture_output=True,
+                ).stdout.count(b"\n"),
+                describe=lines,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Compare in-memory and streaming hash-object on a large file.
+
+    python3 benchmarks/hash_object.py --size 256
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitObject import GitObject, GitBlob
+from GitRepository import GitRepository
+from synthetic import large_file
+
+
+def in_memory(path, repo):
+    with open(path, "rb") as fd:
+        return GitBlob(repo, fd.read()).object_write()
+
+
+def streaming(path, repo):
+    with open(path, "rb") as fd:
+        return GitObject.hash(fd, b"blob", repo)
+
+
+def measure(fn, path, repo):
+    tracemalloc.start()
+    start = time.perf_counter()
+    sha = fn(path, repo)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return sha, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=64, help="File size, in MiB")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = GitRepository.create(os.path.join(tmp, "repo"))
+        path = os.path.join(tmp, "data")
+        large_file(path, size)
+
+        results = dict()
+        for name, fn in (("in-memory", in_memory), ("streaming", streaming)):
+            sha, elapsed, peak = measure(fn, path, repo)
+            results[name] = sha
+            print(
+                f"{name:10} {size / elapsed / 1e6:8.1f} MB/s"
+                f"  peak {peak / 1e6:8.1f} MB  {sha}"
+            )
+
+        if len(set(results.values())) != 1:
+            raise Exception("Both paths should produce the same object!")
+
+
+if __name__ == "__main__":
+    main()
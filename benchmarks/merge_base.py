@@ -0,0 +1,151 @@
+"""Check merge-base and --is-ancestor against a naive full walk, and time both.
+
+    python3 benchmarks/merge_base.py --commits 5000 --branches 6 --merges 0.3
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GitObject import GitCommit, GitTree
+from GitRepository import GitRepository
+
+
+def make_history(repo, commits, branches, merges, seed):
+    """Commit on a few long-lived branches in turn, each commit merging the
+    tip of another branch with probability merges, which makes for plenty
+    of criss-cross merges and so of commits with several merge bases.
+    Return every commit, oldest first."""
+    rng = random.Random(seed)
+    tree = GitTree(repo)
+    tree.items = []
+    tree = tree.object_write()
+
+    history = []
+    tips = [None] * branches
+    date = 1500000000
+    for n in range(commits):
+        lane = rng.randrange(branches)
+        parents = [tips[lane]] if tips[lane] else []
+        other = tips[rng.randrange(branches)]
+        if parents and other and other != tips[lane] and rng.random() < merges:
+            parents.append(other)
+        if not parents and history:
+            # A new branch forks from anywhere in the past.
+            parents = [rng.choice(history)]
+
+        date += rng.randrange(60, 3600)
+        commit = GitCommit(repo)
+        commit.kvlm = collections.OrderedDict()
+        commit.kvlm[b"tree"] = [tree.encode()]
+        if parents:
+            commit.kvlm[b"parent"] = [p.encode() for p in parents]
+        author = b"Synthetic <synthetic@example.com> %d +0000" % date
+        commit.kvlm[b"author"] = [author]
+        commit.kvlm[b"committer"] = [author]
+        commit.kvlm[b""] = [b"Commit %d\n" % n]
+        tips[lane] = commit.object_write()
+        history.append(tips[lane])
+
+    for i, tip in enumerate(tips):
+        if tip:
+            repo.ref_create(f"heads/b{i}", tip)
+    return history
+
+
+def ancestors(meta, sha):
+    seen = {sha}
+    stack = [sha]
+    while stack:
+        for parent in meta(stack.pop())[0]:
+            if parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+    return seen
+
+
+def naive_merge_base(meta, one, two):
+    """The common ancestors that no other common ancestor has as a parent:
+    since the common ancestors are closed under taking parents, those are
+    exactly the ones that aren't an ancestor of another."""
+    common = ancestors(meta, one) & ancestors(meta, two)
+    redundant = {p for c in common for p in meta(c)[0]}
+    return common - redundant
+
+
+def naive_is_ancestor(meta, one, two):
+    return one in ancestors(meta, two)
+
+
+def run(label, fn, pairs):
+    start = time.perf_counter()
+    results = [fn(a, b) for a, b in pairs]
+    elapsed = time.perf_counter() - start
+    print(f"{label:34} {elapsed / len(pairs) * 1000:9.3f} ms/query")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--commits", type=int, default=2000)
+    parser.add_argument("--branches", type=int, default=6)
+    parser.add_argument("--merges", type=float, default=0.3)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = GitRepository.create(tmp)
+        with repo.object_batch():
+            history = make_history(
+                repo, args.commits, args.branches, args.merges, args.seed
+            )
+
+        # Mostly recent commits, as for branch tips, and some from anywhere.
+        rng = random.Random(args.seed)
+        recent = history[-max(2, len(history) // 20) :]
+        pairs = [
+            (rng.choice(recent), rng.choice(recent if i % 2 else history))
+            for i in range(args.queries)
+        ]
+        # Each query gets its own cache of parents, as wyag's walks do.
+        expected = run(
+            "naive merge-base",
+            lambda a, b: naive_merge_base(repo.commit_metas(), a, b),
+            pairs,
+        )
+        ancestry = run(
+            "naive --is-ancestor",
+            lambda a, b: naive_is_ancestor(repo.commit_metas(), a, b),
+            pairs,
+        )
+
+        for graph in (False, True):
+            if graph:
+                repo.commit_graph_write()
+            suffix = " (commit-graph)" if graph else ""
+            bases = run(
+                "merge-base" + suffix, lambda a, b: repo.merge_base(a, [b]), pairs
+            )
+            answers = run(
+                "--is-ancestor" + suffix, lambda a, b: repo.is_ancestor(a, b), pairs
+            )
+            for (a, b), want, got in zip(pairs, expected, bases):
+                if set(got) != want:
+                    raise Exception(f"merge-base {a} {b}: {got} instead of {want}")
+            for (a, b), want, got in zip(pairs, ancestry, answers):
+                if got != want:
+                    raise Exception(f"--is-ancestor {a} {b}: {got} instead of {want}")
+
+        several = sum(len(want) > 1 for want in expected)
+        print(f"{len(pairs)} queries checked, {several} with several merge bases")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Measure the cost of each durability level for loose object writes.
+
+    python3 benchmarks/object_write.py --objects 2000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GitObject import GitBlob
+from GitRepository import GitRepository
+
+LEVELS = [
+    ("no fsync", False, False),
+    ("fsync every object", True, False),
+    ("fsync at batch end", True, True),
+]
+
+
+def write_all(repo, blobs, batch):
+    if batch:
+        with repo.object_batch():
+            for data in blobs:
+                GitBlob(repo, data).object_write()
+    else:
+        for data in blobs:
+            GitBlob(repo, data).object_write()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=4096, help="Object size, in bytes")
+    parser.add_argument("--compression", type=int, default=-1)
+    args = parser.parse_args()
+
+    blobs = [
+        os.urandom(args.size // 2) + b"wyag " * (args.size // 10)
+        for _ in range(args.objects)
+    ]
+
+    for label, fsync, batch in LEVELS:
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = GitRepository.create(os.path.join(tmp, "repo"))
+            repo.compression = args.compression
+            repo.fsync_objects = fsync
+
+            start = time.perf_counter()
+            write_all(repo, blobs, batch)
+            elapsed = time.perf_counter() - start
+
+            # Writing everything again should only cost the hashing.
+            start = time.perf_counter()
+            write_all(repo, blobs, batch)
+            again = time.perf_counter() - start
+
+        print(
+            f"{label:22} {elapsed:7.2f}s  {args.objects / elapsed:8.0f} objects/s"
+            f"  (rewrite {again:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Count reachable objects by walking, and from reachability bitmaps.
+
+    python3 benchmarks/rev_list.py --commits 1000 --repeat 5
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, generate, shape_from, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(tmp, **shape_from(args))
+        repo = GitRepository.find(tmp)
+        # No deltas: only the bitmaps are of interest here.
+        timed("repack with bitmaps", lambda: repo.repack(window=0, bitmap=True))
+
+        head = repo.ref_resolve("HEAD")
+        old = list(itertools.islice(repo.rev_walk([head]), 11))[-1][0]
+        queries = [
+            ("--all", repo.ref_roots(), []),
+            ("HEAD ^(a commit 10 back)", [head], [old]),
+        ]
+        for label, starts, excludes in queries:
+            counts = [
+                timed(
+                    f"{label}{' (bitmap)' if bitmap else ''}",
+                    lambda: repo.rev_list_count(starts, excludes, True, bitmap),
+                    args.repeat,
+                    describe=str,
+                )
+                for bitmap in (False, True)
+            ]
+            if counts[0] != counts[1]:
+                raise Exception(f"{label}: {counts[1]} objects instead of {counts[0]}")
+
+
+if __name__ == "__main__":
+    main()
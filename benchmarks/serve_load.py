@@ -0,0 +1,75 @@
+"""Measure requests per second against `wyag serve` with N clients.
+
+    python3 benchmarks/serve_load.py --repo PATH --clients 8 --requests 2000
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from GitRepository import GitRepository
+from GitServer import GitClient
+
+
+def client(args):
+    path, names, requests, seed = args
+    rng = random.Random(seed)
+    with GitClient(path) as c:
+        for _ in range(requests):
+            c.object(rng.choice(names))
+    return requests
+
+
+def wait_for(path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise Exception("Server did not start")
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repo", default=".", help="Repository to serve")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=1000, help="Per client")
+    args = parser.parse_args()
+
+    repo = GitRepository.find(args.repo)
+    names = [sha for sha, _, _ in repo.object_walk(repo.ref_roots())]
+    if not names:
+        raise Exception("Nothing to request in an empty repository")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "wyag.sock")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "wyag"), "serve", "--socket", path],
+            cwd=repo.worktree,
+        )
+        try:
+            wait_for(path)
+            jobs = [(path, names, args.requests, i) for i in range(args.clients)]
+            start = time.perf_counter()
+            with multiprocessing.Pool(args.clients) as pool:
+                total = sum(pool.map(client, jobs))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(
+        f"{args.clients} clients, {total} requests in {elapsed:.2f}s:"
+        f" {total / elapsed:.0f} requests/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
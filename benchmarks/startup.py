@@ -0,0 +1,107 @@
+"""Measure how long wyag takes to start, and which imports it waits on.
+
+Runs a copy of wyag in a temporary directory, so that no bytecode is
+written into the tree: cold with nothing cached, which is also how every
+run goes with PYTHONDONTWRITEBYTECODE set, then warm once compiled.
+
+    python3 benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import compileall
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold runs must not leave bytecode behind for the next one.
+COLD = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+
+
+def copy_wyag(dest):
+    """Copy the wyag sources, without any cached bytecode, to dest."""
+    os.mkdir(dest)
+    for name in os.listdir(ROOT):
+        if name == "wyag" or name.endswith(".py"):
+            shutil.copy(os.path.join(ROOT, name), dest)
+    return os.path.join(dest, "wyag")
+
+
+def wall(argv, cwd, runs, env=None, created=None):
+    """Time argv, removing what it created, if anything, after each run."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+        if created:
+            shutil.rmtree(os.path.join(cwd, created))
+    return min(times), statistics.median(times)
+
+
+def import_times(argv, cwd):
+    """Return the cumulative import time of each module argv imports
+    directly, as reported by -X importtime, in microseconds."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + argv,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    modules = []
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Only top level imports: nested ones are indented.
+        if not name.startswith("  "):
+            modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="Imports to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wyag = copy_wyag(os.path.join(tmp, "wyag"))
+        repo = os.path.join(tmp, "repo")
+        subprocess.run(
+            [sys.executable, wyag, "init", repo],
+            env=COLD,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        commands = [
+            ("python3 -c pass", [sys.executable, "-c", "pass"], None),
+            ("wyag --help", [sys.executable, wyag, "--help"], None),
+            ("wyag init", [sys.executable, wyag, "init", "new"], "new"),
+            ("wyag show-ref (no refs)", [sys.executable, wyag, "show-ref"], None),
+        ]
+        for warm in (False, True):
+            if warm:
+                compileall.compile_dir(os.path.dirname(wyag), quiet=1)
+            print("Warm, bytecode cached:" if warm else "Cold, no bytecode:")
+            env = None if warm else COLD
+            for label, argv, created in commands:
+                low, median = wall(argv, repo, args.runs, env, created)
+                print(
+                    f"  {label:26} min {low * 1000:7.1f} ms"
+                    f"  median {median * 1000:7.1f} ms"
+                )
+
+        print("\nSlowest imports of wyag show-ref, warm:")
+        for cumulative, name in import_times([wyag, "show-ref"], repo)[: args.top]:
+            print(f"  {name:24} {cumulative / 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Time status with a fresh stat cache, and with every file rehashed.
+
+    python3 benchmarks/status.py --width 12 --depth 3 --jobs 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, commit_tree, generate, shape_from, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    add_shape_arguments(parser, commits=1, width=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        summary = generate(tmp, **shape_from(args))
+        repo = GitRepository.find(tmp)
+        repo.tree_checkout(commit_tree(repo, summary["head"]), tmp.encode())
+        print(f"{summary['files']} files")
+        timed("add", lambda: repo.add([b""], jobs=args.jobs))
+        timed("add again (stat cache)", lambda: repo.add([b""], jobs=args.jobs))
+
+        for jobs in (1, args.jobs):
+            timed(f"status -j {jobs}", lambda: repo.status(jobs=jobs))
+
+        # Make every entry look changed, so that status has to hash them.
+        for jobs in (1, args.jobs):
+            index = repo.index_read()
+            for i in range(len(index)):
+                index.stats[10 * i + 2] = 0
+            repo.index_write(index)
+            timed(f"status -j {jobs}, all rehashed", lambda: repo.status(jobs=jobs))
+
+
+if __name__ == "__main__":
+    main()
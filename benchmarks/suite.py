@@ -0,0 +1,226 @@
+"""Time every wyag subcommand against a synthetic repository, as JSON.
+
+    python3 benchmarks/suite.py --commits 1000 --repeat 5 -o results.json
+    python3 benchmarks/suite.py --compare results.json
+
+Each scenario runs the wyag command line in a fresh process, so that the
+timings are those a user would see, startup included.  The repository is
+generated by benchmarks/synthetic.py unless --repo points at one, in
+which case scenarios that write to it only run if asked for with --only.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from GitRepository import GitRepository
+from synthetic import add_shape_arguments, generate, shape_from
+
+# Each scenario builds the arguments of run i, and optionally its
+# standard input, from the context prepared by prepare().
+SCENARIOS = {
+    "cat-file commit": lambda ctx, i: (["cat-file", "commit", ctx["head"]], None),
+    "cat-file blob": lambda ctx, i: (["cat-file", "blob", ctx["blob"]], None),
+    "cat-file --batch": lambda ctx, i: (["cat-file", "--batch"], ctx["objects"]),
+    "cat-file --batch-check": lambda ctx, i: (
+        ["cat-file", "--batch-check"],
+        ctx["objects"],
+    ),
+    "hash-object": lambda ctx, i: (["hash-object", ctx["blob_path"]], None),
+    "hash-object -r": lambda ctx, i: (["hash-object", "-r", ctx["worktree"]], None),
+    "hash-object -w -r": lambda ctx, i: (
+        ["hash-object", "-w", "-r", ctx["worktree"]],
+        None,
+    ),
+    "log": lambda ctx, i: (["log"], None),
+    "log --oneline": lambda ctx, i: (["log", "--oneline"], None),
+    "log --topo-order": lambda ctx, i: (["log", "--oneline", "--topo-order"], None),
+    "log -n 10": lambda ctx, i: (["log", "--oneline", "-n", "10"], None),
+    "checkout": lambda ctx, i: (
+        ["checkout", "HEAD", os.path.join(ctx["tmp"], f"checkout-{i}")],
+        None,
+    ),
+    "show-ref": lambda ctx, i: (["show-ref"], None),
+    "show-ref -d": lambda ctx, i: (["show-ref", "-d"], None),
+    "tag": lambda ctx, i: (["tag"], None),
+    "tag NAME": lambda ctx, i: (["tag", f"bench-light-{i}"], None),
+    "tag -a NAME": lambda ctx, i: (["tag", "-a", f"bench-annotated-{i}"], None),
+    "rev-list --objects --all": lambda ctx, i: (
+        ["rev-list", "--objects", "--all"],
+        None,
+    ),
+    "rev-parse HEAD": lambda ctx, i: (["rev-parse", "HEAD"], None),
+    "rev-parse PREFIX": lambda ctx, i: (["rev-parse", ctx["head"][:7]], None),
+    "rev-parse --short": lambda ctx, i: (["rev-parse", "--short", "HEAD"], None),
+}
+
+# Scenarios that write to the repository, skipped on an existing one.
+WRITES = {"hash-object -w -r", "tag NAME", "tag -a NAME"}
+
+# Scenarios that read a blob, skipped on a repository without any.
+NEEDS_BLOB = {"cat-file blob", "hash-object"}
+
+
+def prepare(repo, tmp):
+    """Gather what the scenarios need: names of real objects, a worktree
+    to hash, and a file holding the largest blob, if there is one."""
+    head = repo.ref_resolve("HEAD")
+    if head is None:
+        raise Exception("The repository has no commits to benchmark")
+    objects = []
+    blob, blob_size = None, -1
+    for sha, fmt, _ in repo.object_walk(repo.ref_roots()):
+        objects.append(sha)
+        if fmt == b"blob":
+            size = repo.object_info(sha)[1]
+            if size > blob_size:
+                blob, blob_size = sha, size
+
+    worktree = os.path.join(tmp, "worktree")
+    os.makedirs(worktree)
+    commit = repo.object_read(head)
+    tree = repo.object_read(commit.kvlm[b"tree"][0].decode("ascii"))
+    repo.tree_checkout(tree, worktree.encode())
+
+    blob_path = None
+    if blob is not None:
+        blob_path = os.path.join(tmp, "blob")
+        with open(blob_path, "wb") as f:
+            f.write(repo.object_read(blob).blobdata)
+
+    return {
+        "head": head,
+        "blob": blob,
+        "blob_path": blob_path,
+        "objects": "".join(sha + "\n" for sha in objects).encode(),
+        "object_count": len(objects),
+        "worktree": worktree,
+        "tmp": tmp,
+    }
+
+
+def run(repo, ctx, name, repeat):
+    times = []
+    for i in range(repeat):
+        argv, stdin = SCENARIOS[name](ctx, i)
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, os.path.join(ROOT, "wyag")] + argv,
+            cwd=repo.worktree,
+            input=stdin,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        times.append(time.perf_counter() - start)
+        if proc.returncode:
+            raise Exception(f"{name} failed: {proc.stderr.decode().strip()}")
+    return {
+        "runs": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "max": max(times),
+    }
+
+
+def wyag_version():
+    """The commit wyag itself is at, if it is run from a repository."""
+    repo = GitRepository.find(ROOT, required=False)
+    return repo.ref_resolve("HEAD") if repo else None
+
+
+def compare(baseline, results):
+    """Print how the median of each scenario moved since baseline."""
+    old = baseline["scenarios"]
+    for name, result in results["scenarios"].items():
+        if name not in old:
+            continue
+        before, after = old[name]["median"], result["median"]
+        print(
+            f"{name:24} {before * 1000:9.1f} ms -> {after * 1000:9.1f} ms"
+            f"  {(after / before - 1) * 100:+6.1f}%",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repo", help="Benchmark this repository, not a new one")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario")
+    parser.add_argument(
+        "--only", action="append", help="Run only these scenarios (repeatable)"
+    )
+    parser.add_argument("--list", action="store_true", help="List the scenarios")
+    parser.add_argument("-o", "--output", help="Write the results there")
+    parser.add_argument("--compare", help="Compare to the results in this file")
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(SCENARIOS))
+        return
+
+    names = args.only or [
+        name for name in SCENARIOS if not (args.repo and name in WRITES)
+    ]
+    for name in names:
+        if name not in SCENARIOS:
+            raise Exception(f"Unknown scenario {name}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.repo:
+            repo_path = args.repo
+            shape = None
+        else:
+            repo_path = os.path.join(tmp, "repo")
+            shape = shape_from(args)
+            start = time.perf_counter()
+            summary = generate(repo_path, **shape)
+            shape["generate_seconds"] = time.perf_counter() - start
+            shape.update(summary)
+
+        repo = GitRepository.find(repo_path)
+        ctx = prepare(repo, tmp)
+        results = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "wyag": wyag_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repo": shape or {"path": os.path.realpath(repo_path)},
+            "objects": ctx["object_count"],
+            "scenarios": {},
+        }
+        for name in names:
+            if name in NEEDS_BLOB and ctx["blob"] is None:
+                print(f"{name:24} skipped: no blob in the repository", file=sys.stderr)
+                continue
+            results["scenarios"][name] = run(repo, ctx, name, args.repeat)
+            print(
+                f"{name:24} {results['scenarios'][name]['median'] * 1000:9.1f} ms",
+                file=sys.stderr,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    output = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == "__main__":
+    main()
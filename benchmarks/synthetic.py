@@ -0,0 +1,247 @@
+"""Generate a synthetic repository of a given shape, with wyag itself.
+
+    python3 benchmarks/synthetic.py PATH --commits 500 --merges 0.1 --tags 20
+
+The other benchmarks build their fixtures and time their steps with the
+helpers here.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GitObject import GitBlob, GitCommit, GitTag, GitTree, GitTreeLeaf
+from GitRepository import GitRepository
+
+# The knobs of a synthetic repository, and their defaults.
+SHAPE = {
+    "commits": 200,  # Number of commits, merges included
+    "merges": 0.1,  # Fraction of commits that merge a side branch
+    "width": 8,  # Entries per directory: files, then as many subdirectories
+    "depth": 3,  # Levels of subdirectories below the root
+    "changes": 3,  # Files modified by each commit
+    "blob_size": 4096,  # Median blob size, in bytes
+    "blob_spread": 1.5,  # Sigma of the lognormal blob size distribution
+    "tags": 10,  # Number of tags, half of them annotated
+    "seed": 0,
+}
+
+
+class Dir:
+    """A directory of the generated worktree.  Its tree is only written
+    again when something below it has changed."""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.files = dict()
+        self.dirs = dict()
+        self.sha = None
+
+    def write(self, repo):
+        if self.sha is None:
+            items = [
+                GitTreeLeaf(b"100644", name, sha=sha)
+                for name, sha in self.files.items()
+            ]
+            items += [
+                GitTreeLeaf(b"40000", name, sha=d.write(repo))
+                for name, d in self.dirs.items()
+            ]
+            tree = GitTree(repo)
+            tree.items = sorted(items, key=GitTreeLeaf.sort_key)
+            self.sha = tree.object_write()
+        return self.sha
+
+
+class Generator:
+    def __init__(self, repo, shape):
+        self.repo = repo
+        self.shape = shape
+        self.rng = random.Random(shape["seed"])
+        self.root = Dir()
+        self.paths = []
+        self.date = 1500000000
+        self.blobs = 0
+        self.blob_bytes = 0
+
+    def blob(self):
+        size = int(
+            self.rng.lognormvariate(0, self.shape["blob_spread"])
+            * self.shape["blob_size"]
+        )
+        # Text-like content, so that zlib has about as much work as usual.
+        words = b" ".join(
+            b"wyag%d" % self.rng.randrange(1000) for _ in range(size // 8 + 1)
+        )
+        data = words[:size] + b"\n"
+        self.blobs += 1
+        self.blob_bytes += len(data)
+        return GitBlob(self.repo, data).object_write()
+
+    def populate(self, d, depth):
+        for i in range(self.shape["width"]):
+            name = b"file%d.txt" % i
+            d.files[name] = self.blob()
+            self.paths.append((d, name))
+        if depth < self.shape["depth"]:
+            for i in range(self.shape["width"]):
+                sub = d.dirs[b"dir%d" % i] = Dir(d)
+                self.populate(sub, depth + 1)
+
+    def change(self):
+        """Rewrite a few random files."""
+        changes = min(self.shape["changes"], len(self.paths))
+        for d, name in self.rng.sample(self.paths, changes):
+            d.files[name] = self.blob()
+            # Every directory from d up to the root must be written again.
+            while d is not None and d.sha is not None:
+                d.sha = None
+                d = d.parent
+
+    def commit(self, parents, message):
+        self.date += self.rng.randrange(60, 86400)
+        author = b"Synthetic <synthetic@example.com> %d +0000" % self.date
+        commit = GitCommit(self.repo)
+        commit.kvlm = collections.OrderedDict()
+        commit.kvlm[b"tree"] = [self.root.write(self.repo).encode()]
+        if parents:
+            commit.kvlm[b"parent"] = [p.encode() for p in parents]
+        commit.kvlm[b"author"] = [author]
+        commit.kvlm[b"committer"] = [author]
+        commit.kvlm[b""] = [message.encode() + b"\n"]
+        return commit.object_write()
+
+    def run(self):
+        self.populate(self.root, 0)
+        history = [self.commit([], "Initial commit")]
+        while len(history) < self.shape["commits"]:
+            n = len(history)
+            if (
+                n + 2 <= self.shape["commits"]
+                and self.rng.random() < self.shape["merges"]
+            ):
+                # A side branch forking a few commits back, merged right away.
+                base = history[max(0, n - self.rng.randrange(1, 10))]
+                self.change()
+                side = self.commit([base], f"Side commit {n}")
+                history.append(side)
+                self.change()
+                history.append(self.commit([history[-2], side], f"Merge {n}"))
+            else:
+                self.change()
+                history.append(self.commit([history[-1]], f"Commit {n}"))
+
+        head = history[-1]
+        self.repo.ref_create("heads/master", head)
+
+        tagged = self.rng.sample(history, min(self.shape["tags"], len(history)))
+        for i, sha in enumerate(tagged):
+            name = f"v{i}"
+            if i % 2:
+                self.repo.ref_create("tags/" + name, sha)
+                continue
+            tag = GitTag(self.repo)
+            tag.kvlm = collections.OrderedDict()
+            tag.kvlm[b"object"] = [sha.encode()]
+            tag.kvlm[b"type"] = [b"commit"]
+            tag.kvlm[b"tag"] = [name.encode()]
+            tag.kvlm[b"tagger"] = [
+                b"Synthetic <synthetic@example.com> %d +0000" % self.date
+            ]
+            tag.kvlm[b""] = [b"Release " + name.encode() + b"\n"]
+            self.repo.ref_create("tags/" + name, tag.object_write())
+
+        return {
+            "head": head,
+            "commits": len(history),
+            "files": len(self.paths),
+            "blobs": self.blobs,
+            "blob_bytes": self.blob_bytes,
+            "tags": len(tagged),
+        }
+
+
+def generate(path, **shape):
+    """Create a repository at path with the given shape, overriding the
+    defaults in SHAPE, and return a summary of what was written."""
+    unknown = set(shape) - set(SHAPE)
+    if unknown:
+        raise Exception(f"Unknown shape parameters: {', '.join(sorted(unknown))}")
+    shape = dict(SHAPE, **shape)
+
+    repo = GitRepository.create(path)
+    with repo.object_batch():
+        return Generator(repo, shape).run()
+
+
+def add_shape_arguments(parser, **defaults):
+    """Add an option for each shape parameter, with the defaults of SHAPE
+    overridden by defaults."""
+    for name, default in dict(SHAPE, **defaults).items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"), type=type(default), default=default
+        )
+
+
+def shape_from(args):
+    """The shape given by the options of add_shape_arguments()."""
+    return {name: getattr(args, name) for name in SHAPE}
+
+
+def commit_tree(repo, commit):
+    """The tree of commit, read."""
+    return repo.object_read(repo.object_find(commit, b"tree"))
+
+
+def large_file(path, size):
+    """Write a file of size bytes, half random and half repetitive, so
+    that zlib has some real work to do."""
+    block = os.urandom(512 * 1024) + b"wyag " * (512 * 1024 // 5)
+    with open(path, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def stopwatch(fn, repeat=1):
+    """Run fn repeat times, and return its last result and fastest time."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def timed(label, fn, repeat=1, describe=None):
+    """Run fn repeat times and print the fastest time under label, then
+    describe(result) if given.  Return the result."""
+    result, seconds = stopwatch(fn, repeat)
+    line = f"{label:40} {seconds:8.3f}s"
+    if describe:
+        line += f"  {describe(result)}"
+    print(line)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="Where to create the repository")
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    summary = generate(args.path, **shape_from(args))
+    print(
+        f"{summary['commits']} commits, {summary['files']} files,"
+        f" {summary['blobs']} blobs ({summary['blob_bytes'] / 1e6:.1f} MB),"
+        f" {summary['tags']} tags"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare eager and lazy parsing of a large tree.
+
+    python3 benchmarks/tree_parse.py --entries 100000
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GitObject import GitTree, tree_parse
+
+
+def make_tree(entries):
+    names = sorted(f"file-{i:08d}.txt".encode() for i in range(entries))
+    return b"".join(
+        b"100644 " + name + b"\x00" + hashlib.sha1(name).digest() for name in names
+    )
+
+
+def measure(label, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    # Memory is measured on a second run, as tracing slows things down.
+    tracemalloc.start()
+    result = fn()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{label:34} {elapsed * 1000:9.1f} ms  {held / 1e6:8.2f} MB held")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+
+    raw = make_tree(args.entries)
+    middle = f"file-{args.entries // 2:08d}.txt".encode()
+
+    eager = measure("eager: parse", lambda: tree_parse(raw))
+    measure("eager: parse + all hex SHAs", lambda: [i.sha for i in tree_parse(raw)])
+    measure(
+        "eager: parse + find one path",
+        lambda: next(i for i in tree_parse(raw) if i.path == middle),
+    )
+    del eager
+
+    measure("lazy: parse", lambda: GitTree(None, raw))
+    measure(
+        "lazy: parse + all hex SHAs",
+        lambda: [i.sha for i in GitTree(None, raw).items],
+    )
+    measure("lazy: parse + find one path", lambda: GitTree(None, raw).find(middle))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,484 @@
 import argparse
+import sys
+import os
 
-from Handlers import Handlers
-
-argparser = argparse.ArgumentParser(description="The stupid content tracker")
-
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
-
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-argsp.add_argument(
-    "path",
-    metavar="directory",
-    nargs="?",
-    default=".",
-    help="Where to create the repository.",
-)
-
-argsp = argsubparsers.add_parser(
-    "cat-file", help="Provide content of repository objects"
-)
-argsp.add_argument(
-    "type",
-    metavar="type",
-    choices=["blob", "commit", "tag", "tree"],
-    help="Specify the type",
-)
-argsp.add_argument("object", metavar="object", help="The object to display")
-
-argsp = argsubparsers.add_parser(
-    "hash-object", help="Compute object ID and optionally creates a blob from a file"
-)
-argsp.add_argument(
-    "-t",
-    metavar="type",
-    dest="type",
-    choices=["blob", "commit", "tag", "tree"],
-    default="blob",
-    help="Specify the type",
-)
-argsp.add_argument(
-    "-w",
-    dest="write",
-    action="store_true",
-    help="Actually write the object into the database",
-)
-argsp.add_argument("path", help="Read object from <file>")
-
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit", default="HEAD", nargs="?", help="Commit to start at.")
-
-argsp = argsubparsers.add_parser(
-    "checkout", help="Checkout a commit inside of a directory."
-)
-argsp.add_argument("commit", help="The commit or tree to checkout.")
-argsp.add_argument("path", help="The EMPTY directory to checkout on.")
-
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
-
-argsp = argsubparsers.add_parser("tag", help="List and create tags")
-argsp.add_argument(
-    "-a",
-    action="store_true",
-    dest="create_tag_object",
-    help="Whether to create a tag object",
-)
-argsp.add_argument("name", nargs="?", help="The new tag's name")
-argsp.add_argument(
-    "object", default="HEAD", nargs="?", help="The object the new tag will point to"
-)
-
-argsp = argsubparsers.add_parser(
-    "rev-parse", help="Parse revision (or other object) identifiers"
-)
-argsp.add_argument(
-    "--wyag-type",
-    metavar="type",
-    dest="type",
-    choices=["blob", "commit", "tag", "tree"],
-    default=None,
-    help="Specify the expected type",
-)
-argsp.add_argument("name", help="The name to parse")
+import PerfTrace
+
+# Every command, with its help and the function adding its arguments to
+# its parser.  Only the parser of the command being run is built in
+# full: with a dozen commands, building them all is a good part of the
+# startup time of a small command.
+
+
+def args_init(argsp):
+    argsp.add_argument(
+        "path",
+        metavar="directory",
+        nargs="?",
+        default=".",
+        help="Where to create the repository.",
+    )
+
+
+def args_cat_file(argsp):
+    argsp.add_argument(
+        "type",
+        metavar="type",
+        nargs="?",
+        choices=["blob", "commit", "tag", "tree"],
+        help="Specify the type",
+    )
+    argsp.add_argument(
+        "object", metavar="object", nargs="?", help="The object to display"
+    )
+    argsp.add_argument(
+        "--batch",
+        action="store_true",
+        help="Print type, size and contents of each object named on stdin",
+    )
+    argsp.add_argument(
+        "--batch-check",
+        action="store_true",
+        help="Print type and size of each object named on stdin",
+    )
+    argsp.add_argument(
+        "--flush",
+        action="store_true",
+        help="In batch modes, flush the output after each object",
+    )
+
+
+def args_hash_object(argsp):
+    argsp.add_argument(
+        "-t",
+        metavar="type",
+        dest="type",
+        choices=["blob", "commit", "tag", "tree"],
+        default="blob",
+        help="Specify the type",
+    )
+    argsp.add_argument(
+        "-w",
+        dest="write",
+        action="store_true",
+        help="Actually write the object into the database",
+    )
+    argsp.add_argument("path", nargs="*", help="Read object from <file>")
+    argsp.add_argument(
+        "--stdin-paths",
+        action="store_true",
+        help="Read the paths to hash from stdin, one per line",
+    )
+    argsp.add_argument(
+        "-r",
+        dest="recursive",
+        action="store_true",
+        help="Hash every file under the given directories",
+    )
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="Number of threads hashing files (defaults to the number of CPUs)",
+    )
+    argsp.add_argument(
+        "--stats",
+        action="store_true",
+        help="Report files/s and MB/s on stderr when done",
+    )
+
+
+def args_log(argsp):
+    argsp.add_argument(
+        "commit", default=["HEAD"], nargs="*", help="Commits to start at."
+    )
+    argsp.add_argument(
+        "-n",
+        "--max-count",
+        metavar="number",
+        dest="max_count",
+        type=int,
+        default=None,
+        help="Limit the number of commits to output",
+    )
+    argsp.add_argument(
+        "--since",
+        metavar="date",
+        default=None,
+        help="Show commits more recent than a date (timestamp or ISO 8601)",
+    )
+    argsp.add_argument(
+        "--format",
+        choices=["graphviz", "oneline", "medium"],
+        default="graphviz",
+        help="Output format",
+    )
+    argsp.add_argument(
+        "--oneline",
+        action="store_true",
+        help="Shorthand for --format oneline",
+    )
+    argsp.add_argument(
+        "--topo-order",
+        action="store_const",
+        const="topo",
+        default="date",
+        dest="order",
+        help="Never show a commit before all of its children",
+    )
+
+
+def args_checkout(argsp):
+    argsp.add_argument("commit", help="The commit or tree to checkout.")
+    argsp.add_argument(
+        "path", help="The EMPTY directory to checkout on, unless --from is given."
+    )
+    argsp.add_argument(
+        "--from",
+        metavar="commit",
+        dest="old",
+        help="Update path, which holds a checkout of this commit or tree,"
+        " writing only what changed",
+    )
+    argsp.add_argument(
+        "--check",
+        action="store_true",
+        help="With --from, refuse to overwrite or delete modified files",
+    )
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of threads writing files (defaults to the number of CPUs)",
+    )
+
+
+def args_show_ref(argsp):
+    argsp.add_argument(
+        "-d",
+        "--dereference",
+        action="store_true",
+        help="Also show the objects annotated tags point to",
+    )
+
+
+def args_tag(argsp):
+    argsp.add_argument(
+        "-a",
+        action="store_true",
+        dest="create_tag_object",
+        help="Whether to create a tag object",
+    )
+    argsp.add_argument("name", nargs="?", help="The new tag's name")
+    argsp.add_argument(
+        "object", default="HEAD", nargs="?", help="The object the new tag will point to"
+    )
+
+
+def args_diff_tree(argsp):
+    argsp.add_argument(
+        "-r",
+        dest="recursive",
+        action="store_true",
+        help="Recurse into subtrees, listing the files that changed",
+    )
+    argsp.add_argument(
+        "--name-only", action="store_true", help="Show only the changed paths"
+    )
+    argsp.add_argument(
+        "--name-status",
+        action="store_true",
+        help="Show only the changed paths and how they changed",
+    )
+    argsp.add_argument(
+        "-m",
+        dest="merges",
+        action="store_true",
+        help="Compare a merge commit to each of its parents",
+    )
+    argsp.add_argument(
+        "old", help="A commit to compare to its parent, or the tree to compare from"
+    )
+    argsp.add_argument("new", nargs="?", help="The tree to compare to")
+
+
+def args_fsck(argsp):
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="Number of processes checking objects (defaults to the number of CPUs)",
+    )
+    argsp.add_argument(
+        "--no-dangling",
+        action="store_false",
+        dest="dangling",
+        help="Don't list the objects nothing refers to",
+    )
+
+
+def args_add(argsp):
+    argsp.add_argument("path", nargs="+", help="Files or directories to stage")
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="Number of threads hashing files (defaults to the number of CPUs)",
+    )
+
+
+def args_status(argsp):
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of threads checking files (defaults to the number of CPUs)",
+    )
+
+
+def args_merge_base(argsp):
+    argsp.add_argument(
+        "-a", "--all", action="store_true", help="Output all merge bases"
+    )
+    argsp.add_argument(
+        "--is-ancestor",
+        action="store_true",
+        help="Exit with status 0 if the first commit is an ancestor of the"
+        " second, and 1 otherwise",
+    )
+    argsp.add_argument("commit", nargs="+", help="The commits to compare")
+
+
+def args_grep(argsp):
+    argsp.add_argument(
+        "-i", "--ignore-case", action="store_true", help="Ignore case differences"
+    )
+    argsp.add_argument(
+        "-F",
+        "--fixed-strings",
+        action="store_true",
+        dest="fixed",
+        help="Take the pattern as a literal string, not a regular expression",
+    )
+    argsp.add_argument(
+        "-l",
+        "--files-with-matches",
+        action="store_true",
+        dest="files_only",
+        help="Only print the names of files that match",
+    )
+    argsp.add_argument(
+        "-j",
+        metavar="jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="Number of processes searching (defaults to the number of CPUs)",
+    )
+    argsp.add_argument("pattern", help="The regular expression to look for")
+    argsp.add_argument(
+        "rest",
+        nargs=argparse.REMAINDER,
+        metavar="[REV] [-- PATHSPEC...]",
+        help="The revision to search, HEAD by default, and the paths to search"
+        " in: files, directories or glob patterns",
+    )
+
+
+def args_rev_list(argsp):
+    argsp.add_argument(
+        "--objects",
+        action="store_true",
+        help="List the trees and blobs of the commits too",
+    )
+    argsp.add_argument(
+        "--all", action="store_true", help="Start from HEAD and every ref"
+    )
+    argsp.add_argument(
+        "--count", action="store_true", help="Only print the number of objects"
+    )
+    argsp.add_argument(
+        "--use-bitmap-index",
+        action="store_true",
+        dest="use_bitmap",
+        help="Answer from the reachability bitmaps if there are some",
+    )
+    argsp.add_argument(
+        "commit",
+        nargs="*",
+        help="Commits to start at; ^commit excludes what it can reach",
+    )
+
+
+def args_rev_parse(argsp):
+    argsp.add_argument(
+        "--wyag-type",
+        metavar="type",
+        dest="type",
+        choices=["blob", "commit", "tag", "tree"],
+        default=None,
+        help="Specify the expected type",
+    )
+    argsp.add_argument(
+        "--short",
+        action="store_true",
+        help="Abbreviate the object name, keeping it unique",
+    )
+    argsp.add_argument(
+        "--abbrev",
+        metavar="length",
+        type=int,
+        default=7,
+        help="Minimum length of abbreviated names (default 7)",
+    )
+    argsp.add_argument("name", help="The name to parse")
+
+
+def args_repack(argsp):
+    argsp.add_argument(
+        "-d",
+        action="store_true",
+        dest="delete",
+        help="Delete the loose objects and packs made redundant",
+    )
+    argsp.add_argument(
+        "--window",
+        type=int,
+        default=10,
+        help="Number of objects to consider as delta bases",
+    )
+    argsp.add_argument(
+        "--depth", type=int, default=50, help="Maximum length of delta chains"
+    )
+    argsp.add_argument(
+        "-b",
+        "--write-bitmap-index",
+        action="store_true",
+        dest="bitmap",
+        default=None,
+        help="Write reachability bitmaps for the new pack",
+    )
+
+
+def args_gc(argsp):
+    pass
+
+
+def args_pack_refs(argsp):
+    argsp.add_argument(
+        "--all", action="store_true", help="Pack all refs, not only tags"
+    )
+    argsp.add_argument(
+        "--no-prune",
+        action="store_false",
+        dest="prune",
+        help="Keep the loose ref files that got packed",
+    )
+
+
+def args_commit_graph(argsp):
+    argsp.add_argument("action", choices=["write"], help="What to do")
+
+
+def args_serve(argsp):
+    argsp.add_argument(
+        "--socket", required=True, help="Path of the socket to listen on"
+    )
+    argsp.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of threads reading objects",
+    )
+
+
+commands = {
+    "init": ("Initialize a new, empty repository.", args_init),
+    "cat-file": ("Provide content of repository objects", args_cat_file),
+    "grep": ("Print lines matching a pattern in a revision.", args_grep),
+    "hash-object": (
+        "Compute object ID and optionally creates a blob from a file",
+        args_hash_object,
+    ),
+    "log": ("Display history of a given commit.", args_log),
+    "checkout": ("Checkout a commit inside of a directory.", args_checkout),
+    "show-ref": ("List references.", args_show_ref),
+    "tag": ("List and create tags", args_tag),
+    "add": ("Add file contents to the index.", args_add),
+    "status": ("Show the working tree status, in short format.", args_status),
+    "diff-tree": ("Compare the content of two trees.", args_diff_tree),
+    "merge-base": ("Find as good common ancestors as possible.", args_merge_base),
+    "rev-list": ("List reachable commits, and objects.", args_rev_list),
+    "rev-parse": ("Parse revision (or other object) identifiers", args_rev_parse),
+    "fsck": ("Verify the integrity and connectivity of the objects.", args_fsck),
+    "repack": ("Pack all reachable objects into a single packfile.", args_repack),
+    "gc": ("Cleanup unnecessary files and optimize the repository.", args_gc),
+    "pack-refs": ("Pack refs into a single file for efficient access.", args_pack_refs),
+    "commit-graph": (
+        "Write the commit-graph file used to speed up history walks.",
+        args_commit_graph,
+    ),
+    "serve": ("Answer object and ref requests over a Unix socket.", args_serve),
+}
+
+
+def make_parser(command=None):
+    """The argument parser, for command, or for every command."""
+    argparser = argparse.ArgumentParser(description="The stupid content tracker")
+    argparser.add_argument(
+        "--trace-perf",
+        action="store_const",
+        const="table",
+        help="Print where the time went at exit.  Also enabled by WYAG_TRACE_PERF",
+    )
+    argparser.add_argument(
+        "--trace-perf-out",
+        dest="trace_perf",
+        metavar="SPEC",
+        help="Write the performance trace to json:PATH, or chrome:PATH",
+    )
+
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+
+    for name, (help, add_arguments) in commands.items():
+        if command in (None, name):
+            add_arguments(argsubparsers.add_parser(name, help=help))
+
+    return argparser
+
+
+def find_command(argv):
+    """The command argv runs, or None if it names no known command."""
+    args = iter(argv)
+    for arg in args:
+        if arg == "--trace-perf-out":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg if arg in commands else None
+    return None
 
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+    args = make_parser(find_command(argv)).parse_args(argv)
+
+    trace = args.trace_perf or os.environ.get("WYAG_TRACE_PERF")
+    if trace and trace != "0":
+        PerfTrace.enable(trace)
+
+    # Only import the object machinery once the arguments are known to be
+    # good, so that usage errors and --help come back at once.
+    from Handlers import Handlers
 
     handler = getattr(Handlers, args.command.replace("-", "_"))
     handler(args)